@@ -0,0 +1,17 @@
+from web.benchmarks.transition_queries import create_app, lifecycle_counts
+
+# statements one transition may run on SQLite: the loan, its balances, the log, the message and three generations
+STATEMENT_BUDGETS = {
+    "add_to_db": 6,
+    "accept_request": 9,
+    "pay_back": 6,
+    "reject_repayment": 5,
+    "confirm_repayment": 10,
+}
+
+
+def test_transitions_stay_within_their_statement_budget():
+    with create_app().app_context():
+        for step, statements, commits in lifecycle_counts():
+            assert statements <= STATEMENT_BUDGETS[step], "{} ran {} statements".format(step, statements)
+            assert commits == 1, "{} committed {} times".format(step, commits)
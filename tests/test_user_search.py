@@ -0,0 +1,55 @@
+import os
+
+import pytest
+from flask import Flask
+
+from web.benchmarks.user_search import seed
+from web.models.balance_models import UserBalance, SETTLED_EPSILON
+from web.models.db_init import db
+from web.models.search import fold, search_terms, search_users
+from web.models.user_models import User
+
+# TEST_POSTGRES_URL=postgresql://... runs every test on PostgreSQL as well
+BACKENDS = ["sqlite://"] + [url for url in [os.environ.get("TEST_POSTGRES_URL")] if url]
+PREFIXES = ["", "lukasz", "Łuk", "nowak", "kowalska", "nowak-", "user_1", "user_", "zolw", "sciBOR", "x"]
+
+
+@pytest.fixture(params=BACKENDS)
+def app(request):
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = request.param
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        seed(60, 1)
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+def expected(prefix, debtors):
+    # every matching user once, at its first matching term, in codepoint order
+    prefix = fold(prefix)
+    debts = dict(db.session.query(UserBalance.user_id, UserBalance.debt).all())
+    rows = []
+    for user in User.query.all():
+        terms = [term for term in search_terms(user) if term.startswith(prefix)]
+        if terms and (not debtors or debts.get(user.id, 0) >= SETTLED_EPSILON):
+            rows.append((min(terms), user.id))
+    return sorted(rows)
+
+
+def all_pages(prefix, debtors):
+    rows, cursor = [], None
+    while True:
+        page = search_users(prefix, cursor, debtors=debtors, size=7)
+        rows.extend((row.term, row.id) for row in page.items)
+        if page.next_cursor is None:
+            return rows
+        cursor = page.next_cursor
+
+
+@pytest.mark.parametrize("debtors", [False, True])
+@pytest.mark.parametrize("prefix", PREFIXES)
+def test_pages_list_every_match_once_in_term_order(app, prefix, debtors):
+    assert all_pages(prefix, debtors) == expected(prefix, debtors)
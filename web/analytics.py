@@ -0,0 +1,186 @@
+from datetime import date
+
+import numpy as np
+from sqlalchemy import select
+
+from web.metrics import timed
+from web.models.db_init import db
+from web.models.loan_models import Loan, LoanLog, LoanStatus, OUTSTANDING_STATUSES
+from web.models.user_models import User
+
+# (label, first day past the deadline)
+AGING_BUCKETS = [("1-30 days", 1), ("31-60 days", 31), ("61-90 days", 61), ("over 90 days", 91)]
+
+# the columns the reports read, loaded into one structured array per table
+LOAN_COLUMNS = [(Loan.id, "id", "i8"), (Loan.lender_id, "lender", "i8"), (Loan.borrower_id, "borrower", "i8"),
+                (Loan.amount, "amount", "f8"), (Loan.status, "status", "i1"),
+                (Loan.deadline, "deadline", "datetime64[D]")]
+LOG_COLUMNS = [(LoanLog.loan_id, "loan_id", "i8"), (LoanLog.status, "status", "i1"),
+               (LoanLog.timestamp, "timestamp", "datetime64[us]")]
+# a loan is accepted by its first NOT_PAYED log (a later one is a rejected repayment) and repaid by its PAYED log
+LOG_STATUSES = (LoanStatus.NOT_PAYED.value, LoanStatus.PAYED.value)
+
+
+def load_columns(columns, query):
+    dtype = np.dtype([(name, kind) for _, name, kind in columns])
+    # through the session, a @read_only view reads the replica; the driver's tuples go straight into the array,
+    # without a Row per row, and numpy parses the dates SQLite returns as text (or takes the driver's date objects)
+    result = db.session.connection().execute(query)
+    try:
+        rows = result.cursor.fetchall()
+    finally:
+        result.close()
+    return np.fromiter(rows, dtype=dtype, count=len(rows))
+
+
+def first_time(position, mask, time, size):
+    # time of the first log matching the mask for each loan, NaT where there is none;
+    # the logs are sorted by loan and time, so np.unique returns the earliest index of each loan
+    result = np.full(size, np.datetime64("NaT"), dtype=time.dtype)
+    position, time = position[mask], time[mask]
+    _, first = np.unique(position, return_index=True)
+    result[position[first]] = time[first]
+    return result
+
+
+class Snapshot:
+    # the loans and their logs as columns, one array per column, so a report is a few vectorized passes
+    # instead of a query or an ORM object per loan
+    def __init__(self, loans, logs):
+        self.loan_id, self.lender, self.borrower = loans["id"], loans["lender"], loans["borrower"]
+        self.amount, self.status, self.deadline = loans["amount"], loans["status"], loans["deadline"]
+        size = len(loans)
+        # the loans are loaded by id, a log finds its loan by binary search
+        position = np.searchsorted(self.loan_id, logs["loan_id"])
+        known = position < size
+        known[known] = self.loan_id[position[known]] == logs["loan_id"][known]
+        logs, position = logs[known], position[known]
+        # stable, logs with the same timestamp stay in id order
+        order = np.lexsort((logs["timestamp"], position))
+        position, status, time = position[order], logs["status"][order], logs["timestamp"][order]
+        self.accepted_at = first_time(position, status == LoanStatus.NOT_PAYED.value, time, size)
+        self.repaid_at = first_time(position, status == LoanStatus.PAYED.value, time, size)
+
+    def __len__(self):
+        return len(self.loan_id)
+
+
+def load_snapshot():
+    with timed("analytics_snapshot_seconds"):
+        loans = load_columns(LOAN_COLUMNS, select(*(column for column, _, _ in LOAN_COLUMNS)).order_by(Loan.id))
+        logs = load_columns(LOG_COLUMNS, select(*(column for column, _, _ in LOG_COLUMNS))
+                            .where(LoanLog.status.in_(LOG_STATUSES)).order_by(LoanLog.id))
+        return Snapshot(loans, logs)
+
+
+def days_overdue(snapshot, today):
+    return (np.datetime64(today, "D") - snapshot.deadline).astype(np.int64)
+
+
+def monthly_totals(snapshot, user_id=None):
+    # amounts of the accepted loans by the month they were accepted in
+    accepted = ~np.isnat(snapshot.accepted_at)
+    if user_id is None:
+        lent = borrowed = accepted
+    else:
+        lent, borrowed = accepted & (snapshot.lender == user_id), accepted & (snapshot.borrower == user_id)
+    involved = lent | borrowed
+    months, index = np.unique(snapshot.accepted_at[involved].astype("datetime64[M]"), return_inverse=True)
+    amount = snapshot.amount[involved]
+    lent_totals = np.bincount(index, weights=amount * lent[involved], minlength=len(months))
+    borrowed_totals = np.bincount(index, weights=amount * borrowed[involved], minlength=len(months))
+    counts = np.bincount(index, minlength=len(months))
+    return [{"month": str(month), "lent": round(float(lent_total), 2), "borrowed": round(float(borrowed_total), 2),
+             "loans": int(count)}
+            for month, lent_total, borrowed_total, count in zip(months, lent_totals, borrowed_totals, counts)]
+
+
+def overdue_aging(snapshot, today, mask=None):
+    days = days_overdue(snapshot, today)
+    overdue = np.isin(snapshot.status, OUTSTANDING_STATUSES) & (days > 0)
+    if mask is not None:
+        overdue &= mask
+    bucket = np.digitize(days[overdue], [first for _, first in AGING_BUCKETS]) - 1
+    counts = np.bincount(bucket, minlength=len(AGING_BUCKETS))
+    amounts = np.bincount(bucket, weights=snapshot.amount[overdue], minlength=len(AGING_BUCKETS))
+    return [{"bucket": label, "loans": int(count), "amount": round(float(amount), 2)}
+            for (label, _), count, amount in zip(AGING_BUCKETS, counts, amounts)]
+
+
+def repayment_times(snapshot, user_id=None):
+    # from the acceptance of the loan to the lender confirming the repayment
+    repaid = ~np.isnat(snapshot.accepted_at) & ~np.isnat(snapshot.repaid_at)
+    if user_id is not None:
+        repaid &= snapshot.borrower == user_id
+    days = (snapshot.repaid_at[repaid] - snapshot.accepted_at[repaid]) / np.timedelta64(1, "D")
+    return {
+        "repaid_loans": int(days.size),
+        "mean_days": round(float(days.mean()), 2) if days.size else None,
+        "median_days": round(float(np.median(days)), 2) if days.size else None,
+    }
+
+
+def acceptance_rates(snapshot, user_id=None):
+    # a request is rejected when its loan was canceled, every loan that left REQUEST_IN_PROGRESS otherwise was accepted
+    status = snapshot.status if user_id is None else snapshot.status[snapshot.lender == user_id]
+    pending = int(np.count_nonzero(status == LoanStatus.REQUEST_IN_PROGRESS.value))
+    rejected = int(np.count_nonzero(status == LoanStatus.CANCELED.value))
+    accepted = int(status.size) - pending - rejected
+    return {
+        "requests": int(status.size), "accepted": accepted, "rejected": rejected, "pending": pending,
+        "rate": round(accepted / (accepted + rejected), 4) if accepted + rejected else None,
+    }
+
+
+def user_summary(snapshot, today, limit=20):
+    # every user's figures in one pass, grouped by the user id with np.bincount
+    if not len(snapshot):
+        return []
+    size = int(max(snapshot.lender.max(), snapshot.borrower.max())) + 1
+    accepted = ~np.isnat(snapshot.accepted_at)
+    lent = np.bincount(snapshot.lender, weights=snapshot.amount * accepted, minlength=size)
+    borrowed = np.bincount(snapshot.borrower, weights=snapshot.amount * accepted, minlength=size)
+    overdue = np.isin(snapshot.status, OUTSTANDING_STATUSES) & (days_overdue(snapshot, today) > 0)
+    overdue_debt = np.bincount(snapshot.borrower, weights=snapshot.amount * overdue, minlength=size)
+    repaid = accepted & ~np.isnat(snapshot.repaid_at)
+    days = (snapshot.repaid_at[repaid] - snapshot.accepted_at[repaid]) / np.timedelta64(1, "D")
+    repaid_loans = np.bincount(snapshot.borrower[repaid], minlength=size)
+    repaid_days = np.bincount(snapshot.borrower[repaid], weights=days, minlength=size)
+    granted = np.bincount(snapshot.lender, weights=accepted, minlength=size)
+    refused = np.bincount(snapshot.lender, weights=snapshot.status == LoanStatus.CANCELED.value, minlength=size)
+
+    top = np.argsort(-borrowed, kind="stable")[:limit]
+    top = top[(borrowed[top] > 0) | (lent[top] > 0)]
+    usernames = dict(db.session.query(User.id, User.username).filter(User.id.in_(top.tolist())).all())
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_days = repaid_days / repaid_loans
+        rates = granted / (granted + refused)
+    return [{
+        "username": usernames.get(int(user_id), str(user_id)),
+        "lent": round(float(lent[user_id]), 2),
+        "borrowed": round(float(borrowed[user_id]), 2),
+        "overdue": round(float(overdue_debt[user_id]), 2),
+        "mean_repayment_days": round(float(mean_days[user_id]), 2) if repaid_loans[user_id] else None,
+        "acceptance_rate": round(float(rates[user_id]), 4) if granted[user_id] + refused[user_id] else None,
+    } for user_id in top]
+
+
+def report(snapshot, today=None, user=None):
+    today = today or date.today()
+    if user is None:
+        return {
+            "loans": len(snapshot),
+            "monthly": monthly_totals(snapshot),
+            "aging": overdue_aging(snapshot, today),
+            "repayment": repayment_times(snapshot),
+            "acceptance": acceptance_rates(snapshot),
+            "users": user_summary(snapshot, today),
+        }
+    return {
+        "user": user.username,
+        "monthly": monthly_totals(snapshot, user.id),
+        "aging": overdue_aging(snapshot, today, snapshot.borrower == user.id),
+        "aging_owed_to": overdue_aging(snapshot, today, snapshot.lender == user.id),
+        "repayment": repayment_times(snapshot, user.id),
+        "acceptance": acceptance_rates(snapshot, user.id),
+    }
@@ -0,0 +1,251 @@
+import asyncio
+import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from a2wsgi import WSGIMiddleware
+from flask import request, render_template, flash, redirect, url_for, current_app
+from flask_login import login_user, current_user
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import web.inbox as inbox
+import web.jobs as jobs
+import web.security_utils as su
+from web.models import async_db, identity_cache
+from web.models.async_db import find_user, count_unresolved_messages, get_inbox_rows
+from web.models.db_init import db
+from web.models.identity_cache import csrf_token
+from web.models.model_handler import Notification
+from web.models.loan_models import LoanMessage
+from web.models.user_models import LoginLog
+from web.rate_limiter import login_limiter, failed_logins
+from web.timing import RESPONSE_DEADLINES, remaining_until
+from web.user_agent_cache import cached_user_agent
+from web.views.ledger import inbox_event_ids, render_inbox_events
+
+# threads running the Flask app for every route that is not served natively below
+WSGI_THREADS = int(os.environ.get("ASGI_WSGI_THREADS", "32"))
+# scrypt runs in OpenSSL without the GIL, these threads hash while the event loop keeps serving
+HASH_WORKERS = int(os.environ.get("ASGI_HASH_WORKERS", str(os.cpu_count() or 2)))
+
+hash_executor = ThreadPoolExecutor(HASH_WORKERS, thread_name_prefix="password-hash")
+
+
+async def hash_call(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(hash_executor, function, *args)
+
+
+async def login():
+    # views/auth.login without a thread per request: the password check runs on the hash executor
+    # and the response deadline is an asyncio sleep instead of a parked thread
+    deadline = time.monotonic() + RESPONSE_DEADLINES["login"]
+    try:
+        return await attempt_login()
+    finally:
+        await asyncio.sleep(remaining_until(deadline, "login"))
+
+
+async def attempt_login():
+    # the templates read current_user, a client already logged in is loaded here and not on the event loop
+    await asyncio.to_thread(authenticate)
+    username = request.form["username"]
+    password = request.form["password"]
+    if not su.login_data_is_valid(username, password):
+        return render_template("pages/index/login.html"), 401
+    if not login_limiter.allow(username, request.remote_addr):
+        flash("Too many login attempts. Please try again later.", "danger")
+        return render_template("pages/index/login.html"), 429
+
+    # a connection is only taken around the queries, not while the login waits for a hash worker
+    async with async_db.database.sessions() as session:
+        user = await find_user(session, username)
+    if not user:
+        flash("Login unsuccessful. Please check your username and password.", "danger")
+        return render_template("pages/index/login.html"), 401
+    if not await hash_call(su.verify_password, password, user.salt, user.password):
+        flash("Login unsuccessful. Please check your username and password.", "danger")
+        await asyncio.to_thread(failed_logins.add, user.id)
+        return render_template("pages/index/login.html"), 401
+    rehashed = su.password_needs_rehash(user.password)
+    new_hash = await hash_call(su.hash_password, password, user.salt) if rehashed else None
+    user_agent = cached_user_agent(request.headers.get('User-Agent'))
+    current_login = LoginLog(user.id, user_agent)
+    async with async_db.database.sessions() as session:
+        if rehashed:
+            session.add(user)
+            user.password = new_hash
+        session.add(current_login)
+        await session.commit()
+    if rehashed:
+        identity_cache.users.invalidate(username)
+    identity_cache.remember_token(user.id, current_login.token)
+    login_user(user)
+    login_limiter.succeeded(username)
+    await asyncio.to_thread(jobs.queue.enqueue, "login_followup", user_id=user.id, login_log_id=current_login.id)
+    return redirect(url_for("ledger.home"))
+
+
+def authenticate():
+    # the user loader and the token cache may query, so they run on a thread; the connection of
+    # the Flask-SQLAlchemy session goes back to the pool right away instead of at the end of the request
+    user = current_user._get_current_object()
+    token = csrf_token(user) if user.is_authenticated else None
+    db.session.remove()
+    return user, token
+
+
+async def messages_stream():
+    # views/ledger.messages_stream, a waiting stream holds a queue on the event loop instead of a thread
+    user, token = await asyncio.to_thread(authenticate)
+    if not user.is_authenticated:
+        return current_app.login_manager.unauthorized()
+
+    async def render(events):
+        ids = inbox_event_ids(events)
+        async with async_db.database.sessions() as session:
+            messages = await get_inbox_rows(session, user, LoanMessage, ids["message"]) if ids["message"] else []
+            notifications = (await get_inbox_rows(session, user, Notification, ids["notification"])
+                             if ids["notification"] else [])
+            unread = await count_unresolved_messages(session, user)
+        return render_inbox_events(messages, notifications, unread, token)
+
+    last_event_id = request.headers.get("Last-Event-ID", type=int)
+    response = current_app.response_class(mimetype="text/event-stream",
+                                          headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    response.response = inbox.async_stream(user.id, last_event_id, render)
+    return response
+
+
+NATIVE_ROUTES = {
+    ("POST", "/login"): login,
+    ("GET", "/messages/stream"): messages_stream,
+}
+
+
+def build_environ(scope, body, resolve_proxy):
+    # the WSGI environ of the request, so the native views see the same request, session and url_for as Flask
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+        "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope["query_string"].decode("latin1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": scope["client"][0] if scope.get("client") else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": io.StringIO(),
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        key = name.decode("latin1").upper().replace("-", "_")
+        value = value.decode("latin1")
+        if key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[key] = value
+            continue
+        key = "HTTP_" + key
+        environ[key] = environ[key] + "," + value if key in environ else value
+    return resolve_proxy(environ, None)
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def dispatch(flask_app, view):
+    # Flask.full_dispatch_request with an awaited view; the request context is a context variable,
+    # so it follows the view across awaits
+    try:
+        try:
+            response = flask_app.preprocess_request()
+            if response is None:
+                response = await view()
+        except Exception as e:
+            response = flask_app.handle_user_exception(e)
+        return flask_app.finalize_request(response)
+    except Exception as e:
+        return flask_app.handle_exception(e)
+
+
+async def watch_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def send_response(response, send, receive):
+    await send({
+        "type": "http.response.start",
+        "status": response.status_code,
+        "headers": [(name.lower().encode("latin1"), value.encode("latin1"))
+                    for name, value in response.headers.to_wsgi_list()],
+    })
+    if not hasattr(response.response, "__aiter__"):
+        for chunk in response.iter_encoded():
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+        return
+    # a stream ends early when the client goes away, its finally block unsubscribes it from the hub
+    disconnected = asyncio.ensure_future(watch_disconnect(receive))
+    chunks = response.response.__aiter__()
+    try:
+        while True:
+            chunk = asyncio.ensure_future(chunks.__anext__())
+            await asyncio.wait({chunk, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                chunk.cancel()
+                await asyncio.wait({chunk})
+                return
+            try:
+                data = chunk.result()
+            except StopAsyncIteration:
+                break
+            await send({"type": "http.response.body", "body": data.encode("utf8"), "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        disconnected.cancel()
+        await chunks.aclose()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            # runs the jobs due now, like the atexit hook of a gunicorn worker
+            await asyncio.to_thread(jobs.queue.shutdown)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+def create_asgi_app(flask_app):
+    # POST /login and the message stream are served on the event loop, every other route runs the Flask app
+    # in a thread pool; the native views need the async engine set up next to the Flask-SQLAlchemy one
+    async_db.database.init_app(flask_app)
+    wsgi = WSGIMiddleware(flask_app, workers=WSGI_THREADS)
+    # resolves the client address the way the WSGI app does, the wrapped "app" only returns the environ
+    resolve_proxy = ProxyFix(lambda environ, start_response: environ, x_for=flask_app.config["TRUSTED_PROXIES"])
+
+    async def application(scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await lifespan(receive, send)
+        view = NATIVE_ROUTES.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+        if view is None:
+            return await wsgi(scope, receive, send)
+        environ = build_environ(scope, await read_body(receive), resolve_proxy)
+        with flask_app.request_context(environ):
+            response = await dispatch(flask_app, view)
+            await send_response(response, send, receive)
+
+    return application
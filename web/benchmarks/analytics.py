@@ -0,0 +1,199 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+
+from flask import Flask
+from sqlalchemy import case, func, insert, select
+
+import web.analytics as analytics
+from web.models.db_init import db
+from web.models.loan_models import Loan, LoanLog, LoanStatus, OUTSTANDING_STATUSES
+from web.models.user_models import User
+
+TODAY = date(2026, 6, 1)
+REQUEST, NOT_PAYED, PENDING, PAYED, CANCELED = (status.value for status in LoanStatus)
+
+
+def loan_history(rng, requested):
+    # (status, timestamp) of the logs of one loan, the statuses the transitions of Loan leave behind
+    answered = requested + timedelta(hours=rng.uniform(1, 72))
+    outcome = rng.random()
+    if outcome < 0.1:
+        return [(REQUEST, requested)]
+    if outcome < 0.25:
+        return [(REQUEST, requested), (CANCELED, answered)]
+    history = [(REQUEST, requested), (NOT_PAYED, answered)]
+    if outcome < 0.5:
+        return history
+    claimed = answered + timedelta(days=rng.uniform(1, 90))
+    if outcome < 0.6:
+        # a rejected repayment puts the loan back to NOT_PAYED before it is repaid
+        history += [(PENDING, claimed), (NOT_PAYED, claimed + timedelta(hours=5))]
+        claimed += timedelta(days=rng.uniform(1, 10))
+    return history + [(PENDING, claimed), (PAYED, claimed + timedelta(hours=rng.uniform(1, 48)))]
+
+
+def seed(users, loans, seed):
+    # rows are inserted directly, the constructor would spend a scrypt hash on every user
+    rng = random.Random(seed)
+    db.session.execute(insert(User), [{"id": i, "username": "user_{}".format(i), "first_name": "Ala",
+                                       "last_name": "Kot", "password": "", "salt": "", "recovery_password": ""}
+                                      for i in range(1, users + 1)])
+    start = datetime.combine(TODAY, datetime.min.time()) - timedelta(days=730)
+    loan_rows, log_rows = [], []
+    for loan_id in range(1, loans + 1):
+        lender, borrower = rng.sample(range(1, users + 1), 2)
+        requested = start + timedelta(seconds=rng.uniform(0, 700 * 86400))
+        history = loan_history(rng, requested)
+        loan_rows.append({"id": loan_id, "lender_id": lender, "borrower_id": borrower,
+                          "amount": round(rng.uniform(1, 500), 2), "status": history[-1][0],
+                          "deadline": (requested + timedelta(days=rng.randint(7, 120))).date(),
+                          "timestamp": requested, "overdue": False})
+        log_rows.extend({"loan_id": loan_id, "lender_id": lender, "borrower_id": borrower, "message": "",
+                         "status": status, "timestamp": timestamp} for status, timestamp in history)
+    db.session.execute(insert(Loan), loan_rows)
+    db.session.execute(insert(LoanLog), log_rows)
+    db.session.commit()
+
+
+def numpy_report(snapshot=None):
+    report = analytics.report(snapshot or analytics.load_snapshot(), TODAY)
+    return comparable(report["monthly"], report["aging"], report["repayment"]["mean_days"], report["acceptance"],
+                      report["users"])
+
+
+def sql_report():
+    # the same report as GROUP BY queries in the database
+    accepted = (select(LoanLog.loan_id, func.min(LoanLog.timestamp).label("at"))
+                .where(LoanLog.status == NOT_PAYED).group_by(LoanLog.loan_id).subquery())
+    repaid = (select(LoanLog.loan_id, func.min(LoanLog.timestamp).label("at"))
+              .where(LoanLog.status == PAYED).group_by(LoanLog.loan_id).subquery())
+    month = func.strftime("%Y-%m", accepted.c.at)
+    monthly = [{"month": row.month, "lent": round(row.amount, 2), "borrowed": round(row.amount, 2),
+                "loans": row.loans}
+               for row in db.session.execute(select(month.label("month"), func.sum(Loan.amount).label("amount"),
+                                                    func.count().label("loans"))
+                                             .join(accepted, accepted.c.loan_id == Loan.id)
+                                             .group_by(month).order_by(month))]
+
+    days = func.julianday(TODAY.isoformat()) - func.julianday(Loan.deadline)
+    buckets = list(enumerate(analytics.AGING_BUCKETS))
+    bucket = case(*((days >= first, index) for index, (_, first) in reversed(buckets)))
+    aged = dict((row.bucket, (row.loans, row.amount))
+                for row in db.session.execute(select(bucket.label("bucket"), func.count().label("loans"),
+                                                     func.sum(Loan.amount).label("amount"))
+                                              .where(Loan.status.in_(OUTSTANDING_STATUSES), days > 0)
+                                              .group_by(bucket)))
+    aging = [{"bucket": label, "loans": aged.get(index, (0, 0))[0], "amount": round(aged.get(index, (0, 0))[1], 2)}
+             for index, (label, _) in enumerate(analytics.AGING_BUCKETS)]
+
+    mean_days = db.session.execute(select(func.avg(func.julianday(repaid.c.at) - func.julianday(accepted.c.at)))
+                                   .join_from(accepted, repaid, accepted.c.loan_id == repaid.c.loan_id)).scalar()
+
+    counts = db.session.execute(select(func.count(), func.sum(case((Loan.status == REQUEST, 1), else_=0)),
+                                       func.sum(case((Loan.status == CANCELED, 1), else_=0)))).one()
+    acceptance = acceptance_counts(counts[0], counts[1] or 0, counts[2] or 0)
+
+    borrowed = func.sum(Loan.amount).label("borrowed")
+    top = db.session.execute(select(User.username, borrowed).join(Loan, Loan.borrower_id == User.id)
+                             .join(accepted, accepted.c.loan_id == Loan.id).group_by(User.id)
+                             .order_by(borrowed.desc()).limit(20)).all()
+    users = [{"username": username, "borrowed": round(amount, 2)} for username, amount in top]
+    return comparable(monthly, aging, round(mean_days, 2) if mean_days is not None else None, acceptance, users)
+
+
+def orm_report():
+    # every loan and log as an ORM object, the figures summed up in Python loops
+    logs = defaultdict(list)
+    for log in db.session.query(LoanLog).order_by(LoanLog.loan_id, LoanLog.timestamp, LoanLog.id):
+        logs[log.loan_id].append(log)
+    monthly, aged = defaultdict(lambda: [0.0, 0]), defaultdict(lambda: [0, 0.0])
+    borrowed, repayment_days = defaultdict(float), []
+    pending = rejected = 0
+    loans = db.session.query(Loan).all()
+    for loan in loans:
+        pending += loan.status == REQUEST
+        rejected += loan.status == CANCELED
+        accepted_at = next((log.timestamp for log in logs[loan.id] if log.status == NOT_PAYED), None)
+        repaid_at = next((log.timestamp for log in logs[loan.id] if log.status == PAYED), None)
+        if accepted_at:
+            totals = monthly[accepted_at.strftime("%Y-%m")]
+            totals[0] += loan.amount
+            totals[1] += 1
+            borrowed[loan.borrower.username] += loan.amount
+            if repaid_at:
+                repayment_days.append((repaid_at - accepted_at) / timedelta(days=1))
+        days = (TODAY - loan.deadline).days
+        if loan.status in OUTSTANDING_STATUSES and days > 0:
+            index = max(i for i, (_, first) in enumerate(analytics.AGING_BUCKETS) if days >= first)
+            aged[index][0] += 1
+            aged[index][1] += loan.amount
+    top = sorted(borrowed.items(), key=lambda item: -item[1])[:20]
+    return comparable(
+        [{"month": month, "lent": round(amount, 2), "borrowed": round(amount, 2), "loans": count}
+         for month, (amount, count) in sorted(monthly.items())],
+        [{"bucket": label, "loans": aged[index][0], "amount": round(aged[index][1], 2)}
+         for index, (label, _) in enumerate(analytics.AGING_BUCKETS)],
+        round(sum(repayment_days) / len(repayment_days), 2) if repayment_days else None,
+        acceptance_counts(len(loans), pending, rejected),
+        [{"username": username, "borrowed": round(amount, 2)} for username, amount in top])
+
+
+def acceptance_counts(requests, pending, rejected):
+    accepted = requests - pending - rejected
+    return {"requests": requests, "accepted": accepted, "rejected": rejected, "pending": pending,
+            "rate": round(accepted / (accepted + rejected), 4) if accepted + rejected else None}
+
+
+def comparable(monthly, aging, mean_days, acceptance, users):
+    # the figures all three approaches compute, rounded alike so they can be compared
+    return {"monthly": monthly, "aging": aging, "mean_days": mean_days, "acceptance": acceptance,
+            "borrowers": [(user["username"], user["borrowed"]) for user in users]}
+
+
+def timed_report(report, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        db.session.expire_all()
+        result = report()
+    return (time.perf_counter() - start) / rounds * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time of the group ledger report computed with NumPy over a "
+                                                 "column snapshot, with GROUP BY queries and with ORM objects")
+    parser.add_argument("--loans", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print("{:>8} {:<16} {:>11} {:>9}".format("loans", "method", "report ms", "matches"))
+    for count in args.loans:
+        with tempfile.TemporaryDirectory() as directory:
+            app = Flask(__name__)
+            # a file, the snapshot is read the way it is from the application database
+            app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(directory, "analytics.db")
+            db.init_app(app)
+            with app.app_context():
+                db.create_all()
+                seed(args.users, count, args.seed)
+                snapshot = analytics.load_snapshot()
+                # "numpy (loaded)" is the report alone, of a snapshot loaded beforehand
+                reports = {"numpy": numpy_report, "numpy (loaded)": lambda: numpy_report(snapshot),
+                           "sql": sql_report, "orm": orm_report}
+                expected = None
+                for name, report in reports.items():
+                    elapsed, result = timed_report(report, args.rounds)
+                    expected = expected or result
+                    print("{:>8} {:<16} {:>11.1f} {:>9}".format(count, name, elapsed, str(result == expected)))
+                db.session.remove()
+                db.engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
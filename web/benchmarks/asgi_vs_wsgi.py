@@ -0,0 +1,97 @@
+import argparse
+import http.client
+import os
+import tempfile
+import threading
+import urllib.parse
+
+from web.benchmarks.load import PASSWORD, USER_AGENT, LOGIN_SCENARIOS, HttpClient, configure_environment, seed, \
+    usernames, free_port, start_gunicorn, start_uvicorn, run_scenario
+
+SERVERS = {"gunicorn": start_gunicorn, "uvicorn": start_uvicorn}
+
+
+def session_cookie(port, user):
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    connection.request("POST", "/login", urllib.parse.urlencode({"username": user, "password": PASSWORD}),
+                       {"Content-Type": "application/x-www-form-urlencoded", "User-Agent": USER_AGENT})
+    response = connection.getresponse()
+    response.read()
+    connection.close()
+    return response.getheader("Set-Cookie").split(";")[0]
+
+
+def open_streams(port, user, count):
+    # message streams that stay open and idle for the whole run, like the inbox tabs of logged in users
+    cookie = session_cookie(port, user)
+    connections = []
+    for _ in range(count):
+        connection = http.client.HTTPConnection("127.0.0.1", port)
+        connection.request("GET", "/messages/stream", headers={"Cookie": cookie, "User-Agent": USER_AGENT})
+        connections.append(connection)
+
+    def drain(connection):
+        try:
+            response = connection.getresponse()
+            while response.read(1):
+                pass
+        except (OSError, AttributeError):
+            pass  # closed at the end of the run
+
+    for connection in connections:
+        threading.Thread(target=drain, args=(connection,), daemon=True).start()
+    return connections
+
+
+def run(server, args, users):
+    port = free_port()
+    process = SERVERS[server](port)
+    streams = []
+    try:
+        if args.idle_streams:
+            streams = open_streams(port, users[0], args.idle_streams)
+        clients = [HttpClient("http://127.0.0.1:{}".format(port)) for _ in users]
+        return {name: run_scenario(clients, users, scenario, args.login_requests)
+                for name, scenario in LOGIN_SCENARIOS.items()}
+    finally:
+        for connection in streams:
+            connection.close()
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Login throughput of the gunicorn (WSGI) and uvicorn (ASGI) entry "
+                                                 "points, one worker process each")
+    parser.add_argument("--servers", nargs="+", choices=list(SERVERS), default=list(SERVERS))
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--login-requests", type=int, default=512, help="requests per login scenario")
+    parser.add_argument("--threads", type=int, default=16,
+                        help="gunicorn threads, and the threads the ASGI app runs the other Flask routes on")
+    parser.add_argument("--idle-streams", type=int, default=0, help="message streams held open during the run")
+    parser.add_argument("--login-deadline", type=float, default=1.0,
+                        help="LOGIN_RESPONSE_DEADLINE of the seeded app, must cover the hashes queued at this "
+                             "concurrency")
+    args = parser.parse_args()
+    args.loans_per_user = 0
+
+    users = usernames(args.concurrency)
+    with tempfile.TemporaryDirectory() as state_dir:
+        configure_environment(args, state_dir)
+        os.environ.update(GUNICORN_WORKERS="1", GUNICORN_THREADS=str(args.threads),
+                          ASGI_WSGI_THREADS=str(args.threads), JOB_QUEUE_PATH=os.path.join(state_dir, "jobs.db"),
+                          INBOX_STREAM_SECONDS="3600")
+        from web.app import create_app
+        seed(create_app(), users, args.loans_per_user)
+        results = {server: run(server, args, users) for server in args.servers}
+
+    print("{:<10} {:<20} {:>8} {:>7} {:>10} {:>9} {:>9}".format("server", "scenario", "requests", "errors", "req/s",
+                                                                "p50 ms", "p95 ms"))
+    for server, scenarios in results.items():
+        for name, stats in scenarios.items():
+            print("{:<10} {:<20} {requests:>8} {errors:>7} {throughput:>10.1f} {p50_ms:>9.2f} {p95_ms:>9.2f}"
+                  .format(server, name, **stats))
+
+
+if __name__ == "__main__":
+    main()
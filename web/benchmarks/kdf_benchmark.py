@@ -0,0 +1,34 @@
+import argparse
+import secrets
+import time
+
+import web.kdf as kdf
+
+
+def bench(backend, rounds):
+    password, salt = b"ala_ma_K0TA" + secrets.token_bytes(8), secrets.token_hex(16).encode()
+    backend.derive(password, salt, kdf.SCRYPT_N, kdf.SCRYPT_R, kdf.SCRYPT_P, kdf.SCRYPT_DKLEN)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        backend.derive(password, salt, kdf.SCRYPT_N, kdf.SCRYPT_R, kdf.SCRYPT_P, kdf.SCRYPT_DKLEN)
+    return (time.perf_counter() - start) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare scrypt backends used by security_utils.hash_password")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    native, fallback = kdf.BACKENDS["native"], kdf.BACKENDS["pyscrypt"]
+    password, salt = b"ala_ma_K0TA", b"salt"
+    params = (kdf.SCRYPT_N, kdf.SCRYPT_R, kdf.SCRYPT_P, kdf.SCRYPT_DKLEN)
+    assert native.derive(password, salt, *params) == fallback.derive(password, salt, *params), "backends disagree"
+
+    results = {backend.name: bench(backend, args.rounds) for backend in (native, fallback)}
+    for name, seconds in results.items():
+        print("{:<10} {:10.2f} ms/hash".format(name, seconds * 1000))
+    print("speedup    {:10.1f}x".format(results["pyscrypt"] / results["native"]))
+
+
+if __name__ == "__main__":
+    main()
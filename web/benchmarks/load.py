@@ -0,0 +1,333 @@
+import argparse
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from http.cookiejar import CookieJar
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+PASSWORD = "Xq9!vLm2#pR"
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"
+
+# name: (method, path, form for the worker's client and user, expected status)
+LOGIN_SCENARIOS = {
+    "login_ok": ("POST", "/login", lambda client, user: {"username": user, "password": PASSWORD}, 302),
+    "login_bad_password": ("POST", "/login", lambda client, user: {"username": user, "password": PASSWORD + "x"}, 401),
+    "login_unknown_user": ("POST", "/login",
+                           lambda client, user: {"username": "ghost_" + user[-8:], "password": PASSWORD}, 401),
+}
+PAGE_SCENARIOS = {
+    "home": ("GET", "/home", None, 200),
+    "loans": ("GET", "/loans", None, 200),
+    "other_loans": ("GET", "/other-loans", None, 200),
+    "logs": ("GET", "/logs", None, 200),
+    "new_loan": ("GET", "/new-loan", None, 200),
+    # the write path: a loan request with its log, message, balances and generations in one commit
+    "new_loan_post": ("POST", "/new-loan", lambda client, user: new_loan_form(client, user), 302),
+}
+CSRF_TOKEN = re.compile(r'name="CSRFToken" value="([^"]+)"')
+COMPARED_STATS = [("throughput", 1), ("p50_ms", -1), ("p95_ms", -1), ("p99_ms", -1)]
+
+
+class InProcessClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        return self.client.open(path, method=method, data=data, headers={"User-Agent": USER_AGENT}).status_code
+
+    def text(self, path):
+        return self.client.get(path, headers={"User-Agent": USER_AGENT}).get_data(as_text=True)
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpClient:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()), NoRedirect)
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        request = urllib.request.Request(self.base_url + path, data=body, method=method,
+                                         headers={"User-Agent": USER_AGENT})
+        try:
+            with self.opener.open(request) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code
+
+    def text(self, path):
+        request = urllib.request.Request(self.base_url + path, headers={"User-Agent": USER_AGENT})
+        with self.opener.open(request) as response:
+            return response.read().decode("utf8")
+
+
+def configure_environment(args, state_dir):
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(state_dir, "bench.db")
+    os.environ["RATE_LIMIT_STATE"] = os.path.join(state_dir, "login-limiter")
+    os.environ["LOGIN_RESPONSE_DEADLINE"] = str(args.login_deadline)
+    # every worker logs in over and over, the limiter would answer 429 after a few attempts
+    os.environ["LOGIN_USER_BURST"] = os.environ["LOGIN_IP_BURST"] = "1000000000"
+
+
+def usernames(count):
+    return ["bench_user_{}".format(i) for i in range(count)]
+
+
+def seed(app, users, loans_per_user):
+    from web.models.db_init import db
+    from web.models.loan_models import Loan
+    from web.models.user_models import User, LoginMonitor
+
+    with app.app_context():
+        accounts = [User(username, "Ala", "Kot", PASSWORD) for username in users]
+        db.session.add_all(accounts)
+        db.session.commit()
+        db.session.add_all([LoginMonitor(user.id, date.today(), 0) for user in accounts])
+        db.session.commit()
+        for i, borrower in enumerate(accounts):
+            for k in range(1, loans_per_user + 1):
+                loan = Loan(accounts[(i + k) % len(accounts)], borrower, 10 + k, date(2100, 1, 1))
+                loan.add_to_db()
+                if k % 2:
+                    loan.accept_request()
+        db.engine.dispose()
+
+
+def fetch_csrf_token(client):
+    # the token of the client's latest login, rendered into the form like for a browser
+    match = CSRF_TOKEN.search(client.text("/new-loan"))
+    if not match:
+        raise SystemExit("no CSRF token on /new-loan, is the client logged in?")
+    client.csrf_token = match.group(1)
+
+
+def new_loan_form(client, user):
+    # every user borrows from the first one, who borrows from the second
+    users = usernames(2)
+    return {"CSRFToken": client.csrf_token, "lender": users[user == users[0]], "amount": "12.50",
+            "deadline": "2100-01-01"}
+
+
+def register_over_http(base_url, users):
+    for username in users:
+        HttpClient(base_url).request("POST", "/register", {
+            "username": username, "password": PASSWORD, "password-repeat": PASSWORD,
+            "firstname": "Ala", "lastname": "Kot",
+        })
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(name, arguments, port):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")])))
+    process = subprocess.Popen([sys.executable, "-m", name] + arguments, env=env)
+    for _ in range(300):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                raise SystemExit("{} exited with status {}".format(name, process.returncode))
+            time.sleep(0.1)
+    process.terminate()
+    raise SystemExit("{} did not start listening on port {}".format(name, port))
+
+
+def start_gunicorn(port):
+    web_dir = os.path.join(REPO_ROOT, "web")
+    return start_server("gunicorn", ["--chdir", web_dir, "--config", os.path.join(web_dir, "gunicorn.conf.py"),
+                                     "--bind", "127.0.0.1:{}".format(port), "wsgi:app"], port)
+
+
+def start_uvicorn(port, workers=1):
+    return start_server("uvicorn", ["--app-dir", os.path.join(REPO_ROOT, "web"), "--host", "127.0.0.1",
+                                    "--port", str(port), "--workers", str(workers), "--log-level", "warning",
+                                    "asgi:app"], port)
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered))) - 1))]
+
+
+def run_scenario(clients, users, scenario, requests):
+    method, path, form, expected = scenario
+    per_worker = max(1, requests // len(clients))
+
+    def work(worker):
+        client, user, latencies, errors = clients[worker], users[worker], [], 0
+        for _ in range(per_worker):
+            start = time.perf_counter()
+            status = client.request(method, path, form(client, user) if form else None)
+            latencies.append(time.perf_counter() - start)
+            errors += status != expected
+        return latencies, errors
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(len(clients)) as executor:
+        results = list(executor.map(work, range(len(clients))))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for worker_latencies, _ in results for latency in worker_latencies)
+    return {
+        "requests": len(latencies),
+        "errors": sum(errors for _, errors in results),
+        "throughput": len(latencies) / elapsed,
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def timing_uniformity(results, deadline, tolerance):
+    # the three login outcomes must be indistinguishable by their response time
+    medians = {name: results[name]["p50_ms"] for name in LOGIN_SCENARIOS if name in results}
+    spread = max(medians.values()) - min(medians.values())
+    below_deadline = [name for name, median in medians.items() if median < deadline * 1000]
+    return {
+        "medians_ms": medians,
+        "spread_ms": spread,
+        "tolerance_ms": tolerance * 1000,
+        "below_deadline": below_deadline,
+        "ok": spread <= tolerance * 1000 and not below_deadline,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, baseline, threshold):
+    regressions = []
+    if current["mode"] != baseline["mode"]:
+        print("\nwarning: comparing a {} run against a {} baseline".format(current["mode"], baseline["mode"]))
+    print("\n{:<20} {:<12} {:>12} {:>12} {:>8}".format("scenario", "stat", baseline.get("commit") or "baseline",
+                                                      current.get("commit") or "current", "change"))
+    for name, stats in current["scenarios"].items():
+        before = baseline["scenarios"].get(name)
+        if not before:
+            continue
+        for stat, better in COMPARED_STATS:
+            change = (stats[stat] - before[stat]) / before[stat] if before[stat] else 0.0
+            regressed = change * better < -threshold
+            print("{:<20} {:<12} {:>12.2f} {:>12.2f} {:>+7.1%}{}".format(name, stat, before[stat], stats[stat], change,
+                                                                         "  REGRESSION" if regressed else ""))
+            if regressed:
+                regressions.append((name, stat))
+    return regressions
+
+
+def print_results(results):
+    print("{:<20} {:>8} {:>7} {:>10} {:>9} {:>9} {:>9}".format("scenario", "requests", "errors", "req/s",
+                                                               "p50 ms", "p95 ms", "p99 ms"))
+    for name, stats in results["scenarios"].items():
+        print("{:<20} {requests:>8} {errors:>7} {throughput:>10.1f} {p50_ms:>9.2f} {p95_ms:>9.2f} {p99_ms:>9.2f}"
+              .format(name, **stats))
+    uniformity = results["timing_uniformity"]
+    print("login timing spread {:.2f} ms (tolerance {:.2f} ms): {}".format(
+        uniformity["spread_ms"], uniformity["tolerance_ms"], "ok" if uniformity["ok"] else "FAILED"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput and latency of the auth and ledger routes")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--gunicorn", action="store_true", help="seed a temporary database and serve it with gunicorn")
+    target.add_argument("--url", help="benchmark an already running server, users are registered over HTTP")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=400, help="requests per page scenario")
+    parser.add_argument("--login-requests", type=int, default=64, help="requests per login scenario")
+    parser.add_argument("--loans-per-user", type=int, default=20)
+    parser.add_argument("--login-deadline", type=float, default=0.3,
+                        help="LOGIN_RESPONSE_DEADLINE of the seeded app, must exceed one scrypt hash")
+    parser.add_argument("--timing-tolerance", type=float, default=0.02, help="seconds")
+    parser.add_argument("--output", help="write results as JSON")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change reported as a regression")
+    args = parser.parse_args()
+    if args.concurrency < 2:
+        parser.error("--concurrency must be at least 2, a loan request needs another user as the lender")
+
+    users = usernames(args.concurrency)
+    server = None
+    with tempfile.TemporaryDirectory() as state_dir:
+        if args.url:
+            mode = args.url
+            register_over_http(args.url, users)
+            clients = [HttpClient(args.url) for _ in users]
+        else:
+            configure_environment(args, state_dir)
+            from web.app import create_app
+            app = create_app()
+            seed(app, users, args.loans_per_user)
+            if args.gunicorn:
+                port = free_port()
+                server = start_gunicorn(port)
+                mode = "gunicorn"
+                clients = [HttpClient("http://127.0.0.1:{}".format(port)) for _ in users]
+            else:
+                mode = "in-process"
+                clients = [InProcessClient(app) for _ in users]
+        try:
+            for client, user in zip(clients, users):
+                client.request("POST", "/login", {"username": user, "password": PASSWORD})
+            scenarios = {}
+            for name, scenario in LOGIN_SCENARIOS.items():
+                scenarios[name] = run_scenario(clients, users, scenario, args.login_requests)
+            # a successful login issues a new token, the page scenarios use the one of the last login
+            for client in clients:
+                fetch_csrf_token(client)
+            for name, scenario in PAGE_SCENARIOS.items():
+                scenarios[name] = run_scenario(clients, users, scenario, args.requests)
+        finally:
+            if server:
+                server.terminate()
+                server.wait()
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "mode": mode,
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "scenarios": scenarios,
+        "timing_uniformity": timing_uniformity(scenarios, args.login_deadline if not args.url else 0,
+                                               args.timing_tolerance),
+    }
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    failed = not results["timing_uniformity"]["ok"]
+    if args.compare:
+        with open(args.compare) as f:
+            failed |= bool(compare(results, json.load(f), args.threshold))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
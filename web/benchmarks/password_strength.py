@@ -0,0 +1,33 @@
+import argparse
+import math
+import time
+from string import ascii_letters, digits
+
+import web.security_utils as su
+from web.password_strength import SPECIAL_CHARS, strength
+
+PASSWORDS = ["Aaaaaaaa1!", "P@ssw0rd!", "qwerty123!", "zaq12wsx!A", "abcdefgh1!", "k8#Vr2!pQz9",
+             "Tr0ub4dor&3", "correct-horse-battery-staple", "7xK!p2mQ@9rLw4zB"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Password strength estimate per keystroke")
+    parser.add_argument("--rounds", type=int, default=2000)
+    args = parser.parse_args()
+
+    for password in PASSWORDS:
+        bits, matches = su.password_report(password)
+        # every prefix, as the form sends it while typing
+        prefixes = [password[:length] for length in range(1, len(password) + 1)]
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            for prefix in prefixes:
+                su.entropy(prefix)
+        per_call = (time.perf_counter() - start) / (args.rounds * len(prefixes))
+        print("{:<30} {:6.1f} bits {:<11} naive {:6.1f} bits {:8.1f} us/keystroke  {}".format(
+            password, bits, strength(bits), len(password) * math.log2(len(ascii_letters + digits + SPECIAL_CHARS)), per_call * 1e6,
+            " ".join(match.pattern for match in matches)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import argparse
+import random
+import time
+from collections import defaultdict
+
+from web.models.netting import Position, settle
+
+
+def random_ledger(users, loans, seed):
+    rng = random.Random(seed)
+    ledger = []
+    for _ in range(loans):
+        lender, borrower = rng.sample(range(users), 2)
+        ledger.append((lender, borrower, round(rng.uniform(1, 500), 2)))
+    return ledger
+
+
+def positions_from_loans(ledger):
+    # what a rebuild from the loans costs, O(E); the app reads the positions kept by the transitions instead
+    net = defaultdict(float)
+    for lender, borrower, amount in ledger:
+        net[lender] += amount
+        net[borrower] -= amount
+    return [Position(user_id, "user{}".format(user_id), "", "", value) for user_id, value in sorted(net.items())
+            if abs(value) >= 0.005]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time of the greedy settlement plan for growing groups")
+    parser.add_argument("--users", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+    parser.add_argument("--loans-per-user", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print("{:>8} {:>9} {:>10} {:>10} {:>12} {:>10}".format("users", "loans", "pairs", "transfers", "positions ms",
+                                                         "settle ms"))
+    for users in args.users:
+        ledger = random_ledger(users, users * args.loans_per_user, args.seed)
+        pairs = len({(lender, borrower) for lender, borrower, _ in ledger})
+        start = time.perf_counter()
+        positions = positions_from_loans(ledger)
+        aggregated = time.perf_counter()
+        transfers = settle(positions)
+        settled = time.perf_counter()
+        print("{:>8} {:>9} {:>10} {:>10} {:>12.1f} {:>10.1f}".format(
+            users, len(ledger), pairs, len(transfers), (aggregated - start) * 1000, (settled - aggregated) * 1000))
+
+
+if __name__ == "__main__":
+    main()
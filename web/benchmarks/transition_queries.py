@@ -0,0 +1,60 @@
+from datetime import date
+
+from flask import Flask
+from sqlalchemy import event
+
+from web.models.db_init import db
+from web.models.loan_models import Loan
+from web.models.user_models import User
+
+
+LIFECYCLE = ["accept_request", "pay_back", "reject_repayment", "pay_back", "confirm_repayment"]
+
+
+def count_queries(function):
+    statements, commits = [], []
+    listeners = [
+        ("before_cursor_execute", lambda *args: statements.append(args[2])),
+        ("commit", lambda *args: commits.append(1)),
+    ]
+    for name, listener in listeners:
+        event.listen(db.engine, name, listener)
+    try:
+        function()
+    finally:
+        for name, listener in listeners:
+            event.remove(db.engine, name, listener)
+    return len(statements), len(commits)
+
+
+def lifecycle_counts():
+    # (transition, statements, commits) of one loan taken through every transition, in an app context
+    db.create_all()
+    lender, borrower = User("lender", "Ala", "Kot", "Xq9!vLm2#pR"), User("borrower", "Ola", "Pies", "Xq9!vLm2#pR")
+    db.session.add_all([lender, borrower])
+    db.session.commit()
+
+    loan = Loan(lender, borrower, 10, date(2100, 1, 1))
+    yield ("add_to_db", *count_queries(loan.add_to_db))
+    for step in LIFECYCLE:
+        db.session.expire_all()
+        loan = db.session.get(Loan, loan.id)
+        yield (step, *count_queries(getattr(loan, step)))
+
+
+def create_app():
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    db.init_app(app)
+    return app
+
+
+def main():
+    with create_app().app_context():
+        print("{:<20} {:>10} {:>8}".format("transition", "statements", "commits"))
+        for counts in lifecycle_counts():
+            print("{:<20} {:>10} {:>8}".format(*counts))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import argparse
+import random
+import time
+
+from user_agents import parse
+
+from web.user_agent_cache import cached_user_agent, cache_stats, parse_user_agent
+
+USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:121.0) Gecko/20100101 Firefox/121.0",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Safari/605.1.15",
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Mobile/15E148 Safari/604.1",
+    "Mozilla/5.0 (Linux; Android 14; Pixel 8) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Mobile Safari/537.36",
+    "Mozilla/5.0 (iPad; CPU OS 17_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Mobile/15E148 Safari/604.1",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36 Edg/120.0.0.0",
+    "python-requests/2.31.0",
+    "Googlebot/2.1 (+http://www.google.com/bot.html)",
+]
+
+
+def bench(fn, headers):
+    start = time.perf_counter()
+    for header in headers:
+        fn(header)
+    return (time.perf_counter() - start) / len(headers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="User-agent parsing cost with and without the LRU cache")
+    parser.add_argument("--logins", type=int, default=2000)
+    args = parser.parse_args()
+
+    # a few browsers make up almost all logins
+    headers = random.Random(0).choices(USER_AGENTS, weights=[30, 15, 12, 10, 10, 8, 5, 5, 3, 2], k=args.logins)
+    assert all(cached_user_agent(header) == parse_user_agent(header) for header in USER_AGENTS), "cache disagrees"
+    cached_user_agent.cache_clear()
+
+    results = {
+        "user_agents.parse": bench(parse, headers),
+        "uncached": bench(parse_user_agent, headers),
+        "cached": bench(cached_user_agent, headers),
+    }
+    for name, seconds in results.items():
+        print("{:<18} {:10.1f} us/login".format(name, seconds * 1e6))
+    print("speedup            {:10.1f}x".format(results["uncached"] / results["cached"]))
+    stats = cache_stats()
+    print("cache              {hits} hits, {misses} misses, hit rate {hit_rate:.1%}".format(**stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import argparse
+import random
+import time
+from types import SimpleNamespace
+
+from flask import Flask
+from sqlalchemy import insert
+
+from web.models.balance_models import UserBalance
+from web.models.db_init import db
+from web.models.search import UserSearchTerm, search_rows, search_users
+from web.models.user_models import User
+
+FIRST_NAMES = ["Ala", "Łukasz", "Żaneta", "Ola", "Piotr", "Ścibor", "Katarzyna", "Jan"]
+LAST_NAMES = ["Kot", "Żółw", "Nowak-Kowalska", "Śliwa", "Łoś", "Pies", "Zając", "Wróbel"]
+
+
+def seed(count, seed):
+    # rows are inserted directly, the constructor would spend a scrypt hash on every user
+    rng = random.Random(seed)
+    users = [{"id": i, "username": "user_{}".format(i), "first_name": rng.choice(FIRST_NAMES),
+              "last_name": rng.choice(LAST_NAMES), "password": "", "salt": "", "recovery_password": ""}
+             for i in range(1, count + 1)]
+    db.session.execute(insert(User), users)
+    db.session.execute(insert(UserBalance), [{"user_id": user["id"], "debt": rng.choice([0, 0, 10]), "credit": 0}
+                                             for user in users])
+    db.session.execute(insert(UserSearchTerm), search_rows([SimpleNamespace(**user) for user in users]))
+    db.session.commit()
+
+
+def timed_page(prefix, debtors, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        page = search_users(prefix, debtors=debtors)
+    return (time.perf_counter() - start) / rounds * 1000, len(page.items)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time of one page of the user search for growing user bases")
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print("{:>8} {:<10} {:>8} {:>6} {:>9}".format("users", "query", "debtors", "rows", "page ms"))
+    for count in args.users:
+        app = Flask(__name__)
+        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        db.init_app(app)
+        with app.app_context():
+            db.create_all()
+            seed(count, args.seed)
+            for prefix in ("", "lukasz", "zolw", "user_99"):
+                for debtors in (False, True):
+                    elapsed, rows = timed_page(prefix, debtors, args.rounds)
+                    print("{:>8} {:<10} {:>8} {:>6} {:>9.2f}".format(count, repr(prefix), str(debtors), rows, elapsed))
+
+
+if __name__ == "__main__":
+    main()
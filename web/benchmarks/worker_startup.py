@@ -0,0 +1,69 @@
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from web.benchmarks.load import REPO_ROOT, free_port
+
+READY_LINE = re.compile(r"worker (\d+) ready ([\d.]+) ms after fork")
+
+
+def boot(preload, workers, state_dir, timeout):
+    # starts gunicorn, waits until every worker logged that it is ready, then stops it
+    env = dict(os.environ, GUNICORN_PRELOAD=str(preload), GUNICORN_WORKERS=str(workers),
+               DATABASE_URL="sqlite:///" + os.path.join(state_dir, "bench.db"),
+               RATE_LIMIT_STATE=os.path.join(state_dir, "login-limiter"),
+               PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")])))
+    web_dir = os.path.join(REPO_ROOT, "web")
+    # without --preload every worker would run the migrations of the empty database at the same time
+    subprocess.run([sys.executable, "-m", "flask", "--app", "web.app", "migrate"], env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-m", "gunicorn", "--chdir", web_dir,
+                                "--config", os.path.join(web_dir, "gunicorn.conf.py"),
+                                "--bind", "127.0.0.1:{}".format(free_port()), "wsgi:app"],
+                               env=env, stderr=subprocess.PIPE, text=True)
+    boots = []
+    try:
+        for line in process.stderr:
+            match = READY_LINE.search(line)
+            if match:
+                boots.append(float(match.group(2)))
+                if len(boots) == workers:
+                    break
+            if time.perf_counter() - started > timeout:
+                break
+        all_ready = time.perf_counter() - started
+    finally:
+        process.terminate()
+        process.communicate()
+    if len(boots) < workers:
+        raise SystemExit("only {} of {} workers became ready".format(len(boots), workers))
+    return boots, all_ready
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time gunicorn workers take to boot, with and without --preload")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    print("{:<10} {:>16} {:>16} {:>18}".format("preload", "worker p50 ms", "worker max ms", "all ready ms"))
+    for preload in (False, True):
+        boots, totals = [], []
+        for _ in range(args.rounds):
+            with tempfile.TemporaryDirectory() as state_dir:
+                worker_boots, all_ready = boot(preload, args.workers, state_dir, args.timeout)
+            boots.extend(worker_boots)
+            totals.append(all_ready * 1000)
+        print("{:<10} {:>16.1f} {:>16.1f} {:>18.1f}".format(str(preload), statistics.median(boots), max(boots),
+                                                           statistics.median(totals)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import json
+from datetime import date
+
+import click
+from flask import Blueprint, current_app
+
+import web.analytics as analytics
+
+import web.jobs as jobs
+import web.ledger_io as ledger_io
+import web.static_build as static_build
+import web.template_cache as template_cache
+from web.models.db_init import db
+from web.models.migrations import apply_migrations
+from web.models.model_handler import rebuild_balances, mark_overdue_loans
+from web.models.netting import settlement_plan
+from web.models.user_models import User
+
+# top level `flask` commands, they need the app the factory built
+bp = Blueprint("commands", __name__, cli_group=None)
+
+
+@bp.cli.command("migrate")
+def migrate():
+    applied = apply_migrations()
+    for version, description in applied:
+        click.echo("Applied migration {}: {}".format(version, description))
+    if not applied:
+        click.echo("Database schema is up to date.")
+
+
+@bp.cli.command("run-jobs")
+@click.option("--drain", is_flag=True, help="run the jobs that are due and exit")
+def run_jobs(drain):
+    if drain:
+        jobs.queue.drain(float("inf"))
+    else:
+        try:
+            jobs.queue.work()
+        except KeyboardInterrupt:
+            jobs.queue.shutdown()
+    click.echo("{} jobs left in the queue.".format(jobs.queue.pending()))
+
+
+@bp.cli.command("build-static")
+def build_static_command():
+    built = static_build.build(current_app.static_folder)
+    click.echo("Built {} assets, restart the server to serve them.".format(len(built)))
+
+
+@bp.cli.command("compile-templates")
+def compile_templates_command():
+    click.echo("Compiled {} templates.".format(template_cache.compile_templates(current_app)))
+
+
+@bp.cli.command("scan-overdue")
+def scan_overdue_command():
+    click.echo("Marked {} loans overdue.".format(mark_overdue_loans()))
+
+
+@bp.cli.command("export-ledger")
+@click.argument("what", type=click.Choice(["loans", "logs"]))
+@click.option("--format", "fmt", type=click.Choice(list(ledger_io.FORMATS)), default="csv")
+@click.option("--output", type=click.File("w"), default="-")
+def export_ledger_command(what, fmt, output):
+    export = ledger_io.export_loans if what == "loans" else ledger_io.export_loan_logs
+    for chunk in export(fmt):
+        output.write(chunk)
+
+
+@bp.cli.command("import-loans")
+@click.argument("source", type=click.File("r"))
+@click.option("--format", "fmt", type=click.Choice(list(ledger_io.FORMATS)), default="csv")
+@click.option("--batch-size", type=int, default=ledger_io.IMPORT_BATCH_SIZE)
+def import_loans_command(source, fmt, batch_size):
+    result = ledger_io.import_loans(source, fmt, batch_size=batch_size)
+    for error in result.errors:
+        click.echo(error, err=True)
+    click.echo("Imported {} loans, rejected {} rows.".format(result.imported, result.rejected))
+
+
+@bp.cli.command("rebuild-balances")
+def rebuild_balances_command():
+    with db.engine.begin() as connection:
+        rebuild_balances(connection)
+    click.echo("Balances rebuilt.")
+
+
+@bp.cli.command("check-query-plans")
+def check_query_plans():
+    from web.models.query_plans import check_query_plans as check
+
+    failed = False
+    for name, ok, plan in check():
+        click.echo("{} {}".format("OK  " if ok else "SCAN", name))
+        for detail in plan:
+            click.echo("       " + detail)
+        failed = failed or not ok
+    if failed:
+        raise SystemExit(1)
+
+
+@bp.cli.command("settlement-plan")
+def settlement_plan_command():
+    plan = settlement_plan()
+    for transfer in plan.transfers:
+        click.echo("{} -> {}: {:.2f}".format(transfer.payer.username, transfer.payee.username, transfer.amount))
+    click.echo("{} transfers settle {} outstanding debts.".format(len(plan.transfers), plan.pairs))
+
+
+def echo_table(title, rows, columns):
+    click.echo(title)
+    if not rows:
+        click.echo("  none")
+    for row in rows:
+        click.echo("  " + "  ".join("{:>14}".format("-" if row[column] is None else str(row[column]))
+                                    for column in columns))
+
+
+@bp.cli.command("ledger-report")
+@click.option("--user", "username", help="report of one user instead of the group")
+@click.option("--today", type=click.DateTime(["%Y-%m-%d"]), help="date the overdue loans are aged at")
+@click.option("--json", "as_json", is_flag=True)
+def ledger_report_command(username, today, as_json):
+    user = None
+    if username:
+        user = db.session.query(User).filter_by(username=username).first()
+        if user is None:
+            raise click.BadParameter("no such user", param_hint="--user")
+    report = analytics.report(analytics.load_snapshot(), today.date() if today else date.today(), user)
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+        return
+    echo_table("Monthly (month, lent, borrowed, loans):", report["monthly"], ["month", "lent", "borrowed", "loans"])
+    echo_table("Overdue debts (age, loans, amount):", report["aging"], ["bucket", "loans", "amount"])
+    if user is not None:
+        echo_table("Overdue debts owed to the user:", report["aging_owed_to"], ["bucket", "loans", "amount"])
+    echo_table("Repayment (loans, mean days, median days):", [report["repayment"]],
+               ["repaid_loans", "mean_days", "median_days"])
+    echo_table("Requests (requests, accepted, rejected, pending, rate):", [report["acceptance"]],
+               ["requests", "accepted", "rejected", "pending", "rate"])
+    if user is None:
+        echo_table("Largest borrowers (user, lent, borrowed, overdue, repayment days, acceptance rate):",
+                   report["users"], ["username", "lent", "borrowed", "overdue", "mean_repayment_days",
+                                     "acceptance_rate"])
@@ -0,0 +1,114 @@
+import argparse
+import heapq
+import mmap
+import os
+import tempfile
+
+
+DEFAULT_DICTIONARY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources", "500-worst-passwords.txt")
+SORTED_INDEX_SUFFIX = ".sorted"
+SET_INDEX_MAX_BYTES = 16 * 1024 * 1024
+BUILD_CHUNK_LINES = 1_000_000
+
+
+class SetIndex:
+    def __init__(self, path):
+        with open(path, "r", encoding="utf8", errors="ignore") as f:
+            self.words = frozenset(line.strip() for line in f if line.strip())
+
+    def __contains__(self, word):
+        return word in self.words
+
+
+class SortedFileIndex:
+    # file produced by `build`: unique lines sorted bytewise, looked up by binary search over the mapped pages,
+    # which the OS page cache shares between all worker processes
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+
+    def __contains__(self, word):
+        key = word.encode("utf8")
+        data = self.data
+        lo, hi = 0, len(data)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = data.rfind(b"\n", 0, mid) + 1
+            end = data.find(b"\n", start)
+            if end == -1:
+                end = len(data)
+            line = data[start:end]
+            if line == key:
+                return True
+            if line < key:
+                lo = end + 1
+            else:
+                hi = start
+        return False
+
+
+def load(path=None):
+    path = path or os.environ.get("PASSWORD_DICTIONARY", DEFAULT_DICTIONARY)
+    if path.endswith(SORTED_INDEX_SUFFIX):
+        return SortedFileIndex(path)
+    if os.path.getsize(path) > SET_INDEX_MAX_BYTES:
+        raise ValueError("{} is too large to keep in memory, build a sorted index with "
+                         "`python -m web.dictionary_index build`".format(path))
+    return SetIndex(path)
+
+
+def _sorted_chunks(source, tmp_dir):
+    chunk = set()
+    with open(source, "rb") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                chunk.add(line)
+            if len(chunk) >= BUILD_CHUNK_LINES:
+                yield _write_chunk(chunk, tmp_dir)
+                chunk = set()
+    if chunk:
+        yield _write_chunk(chunk, tmp_dir)
+
+
+def _write_chunk(chunk, tmp_dir):
+    fd, path = tempfile.mkstemp(dir=tmp_dir)
+    with os.fdopen(fd, "wb") as f:
+        f.writelines(line + b"\n" for line in sorted(chunk))
+    return path
+
+
+def build(source, destination):
+    # external merge sort, so corpora larger than memory can be indexed
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        chunk_files = [open(path, "rb") for path in _sorted_chunks(source, tmp_dir)]
+        count, previous = 0, None
+        with open(destination, "wb") as out:
+            # chunks are sorted and looked up without the newline, merged with it a byte below b"\n" (a tab)
+            # after a shared prefix would sort the other way
+            for line in heapq.merge(*(map(bytes.rstrip, f) for f in chunk_files)):
+                if line != previous:
+                    out.write(line + b"\n")
+                    count += 1
+                    previous = line
+        for f in chunk_files:
+            f.close()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a memory-mapped breached-password index")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build")
+    build_parser.add_argument("source")
+    build_parser.add_argument("destination", help="must end with " + SORTED_INDEX_SUFFIX)
+    args = parser.parse_args()
+
+    if not args.destination.endswith(SORTED_INDEX_SUFFIX):
+        parser.error("destination must end with " + SORTED_INDEX_SUFFIX)
+    count = build(args.source, args.destination)
+    print("Indexed {} passwords into {}".format(count, args.destination))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+import gc
+import os
+import sys
+import time
+
+bind = "0.0.0.0:5000"
+workers = int(os.environ.get("GUNICORN_WORKERS", "2"))
+# requests waiting for their response deadline only hold a thread, not the whole worker
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "32"))
+# the app, its lookup tables and the schema check are built once in the master instead of in every worker
+preload_app = os.environ.get("GUNICORN_PRELOAD", "True") == "True"
+
+
+def when_ready(server):
+    # objects of the preloaded app are never collected, so the workers' collector does not touch
+    # (and copy) the pages they share with the master
+    if preload_app:
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.monotonic()
+    storage = sys.modules.get("web.storage")
+    if preload_app and storage:
+        storage.dispose_engines(server.app.wsgi())
+
+
+def post_worker_init(worker):
+    boot = time.monotonic() - worker.forked_at
+    worker.log.info("worker %s ready %.1f ms after fork", worker.pid, boot * 1000)
+    metrics = sys.modules.get("web.metrics")
+    if metrics:
+        metrics.registry.observe("worker_boot_seconds", boot)
+
+
+def worker_exit(server, worker):
+    # finish the queued side effects of this worker's requests before it goes away
+    jobs = sys.modules.get("web.jobs")
+    if jobs:
+        jobs.queue.shutdown()
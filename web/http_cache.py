@@ -0,0 +1,72 @@
+import hashlib
+import os
+from functools import wraps
+
+from flask import request, session, make_response
+from flask_login import current_user
+
+from web.models.balance_models import ledger_generation
+from web.models.identity_cache import csrf_token
+from web.static_build import BUILD_DIR, load_manifest
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+manifest = {}
+# changes with every deploy that changes a template or an asset, so a browser never keeps a page of the old release
+release = ""
+
+
+def page_etag(*parts):
+    return hashlib.sha256(repr((release,) + parts).encode("utf8")).hexdigest()[:32]
+
+
+def conditional(scope, with_token=False):
+    # scope(user) -> ledger generation the page is rendered from; a matching If-None-Match is answered
+    # with 304 before the view runs, so neither the queries nor the rendering happen
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if "_flashes" in session:
+                # flashed messages are shown once, the page has to be rendered with them
+                return view(*args, **kwargs)
+            parts = [request.full_path, current_user.id, ledger_generation(scope(current_user))]
+            if with_token:
+                parts.append(csrf_token(current_user))
+            etag = page_etag(*parts)
+            if request.if_none_match.contains(etag):
+                response = make_response("", 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = "private, no-cache"
+            return response
+        return wrapper
+    return decorator
+
+
+def release_id(app):
+    digest = hashlib.sha256()
+    for folder in (app.template_folder and os.path.join(app.root_path, app.template_folder), app.static_folder):
+        for root, dirs, files in os.walk(folder or ""):
+            dirs.sort()
+            for name in sorted(files):
+                stat = os.stat(os.path.join(root, name))
+                digest.update("{}:{}:{}".format(os.path.join(root, name), stat.st_size, stat.st_mtime_ns).encode())
+    return digest.hexdigest()[:16]
+
+
+def init_app(app):
+    global release
+    manifest.update(load_manifest(app.static_folder))
+    release = release_id(app)
+
+    @app.url_defaults
+    def fingerprinted_static(endpoint, values):
+        if endpoint == "static" and values.get("filename") in manifest:
+            values["filename"] = manifest[values["filename"]]
+
+    @app.after_request
+    def cache_fingerprinted_static(response):
+        if request.endpoint == "static" and request.view_args["filename"].startswith(BUILD_DIR + "/"):
+            response.headers["Cache-Control"] = IMMUTABLE
+        return response
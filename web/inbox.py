@@ -0,0 +1,255 @@
+import asyncio
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from sqlalchemy import event
+
+from web.models.loan_models import LoanMessage
+from web.models.notification_model import Notification
+from web.storage import RoutingSession
+
+logger = logging.getLogger(__name__)
+
+POLL_SECONDS = float(os.environ.get("INBOX_POLL_SECONDS", "0.5"))
+HEARTBEAT_SECONDS = 15
+STREAM_SECONDS = float(os.environ.get("INBOX_STREAM_SECONDS", "300"))
+RETENTION_SECONDS = 15 * 60
+# streams one worker holds open at once, each takes a request thread for up to STREAM_SECONDS
+MAX_STREAMS = int(os.environ.get("INBOX_MAX_STREAMS", "8"))
+# past the cap a browser reconnects after this long and catches up from the event log, a poll instead of a stream
+BUSY_RETRY_MS = int(os.environ.get("INBOX_BUSY_RETRY_MS", "20000"))
+KINDS = {LoanMessage: "message", Notification: "notification"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS inbox_events (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    row_id INTEGER NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_inbox_events_user ON inbox_events (user_id, id);
+"""
+
+
+class InboxHub:
+    # commits append to a small SQLite event log shared by the workers on the host; each worker polls it with
+    # a single thread, only while someone is subscribed, and hands new events to its own subscribers in memory
+    def __init__(self):
+        self.path = None
+        self.local = threading.local()
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.thread_pid = None
+        self.last_id = 0
+        self.stream_slots = threading.BoundedSemaphore(MAX_STREAMS)
+
+    def init_app(self, app):
+        self.path = os.environ.get("INBOX_EVENTS_PATH") or os.path.join(app.instance_path, "inbox_events.db")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.connection().executescript(SCHEMA)
+
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection, self.local.pid = connection, os.getpid()
+        return connection
+
+    def publish(self, events):
+        # events: [(user_id, kind, row_id)]
+        now = time.time()
+        self.connection().executemany("INSERT INTO inbox_events (user_id, kind, row_id, created) VALUES (?, ?, ?, ?)",
+                                      [(user_id, kind, row_id, now) for user_id, kind, row_id in events])
+
+    def latest_id(self):
+        return self.connection().execute("SELECT coalesce(max(id), 0) FROM inbox_events").fetchone()[0]
+
+    def replay(self, user_id, after_id):
+        return self.connection().execute("SELECT id, user_id, kind, row_id FROM inbox_events "
+                                         "WHERE user_id = ? AND id > ? ORDER BY id", (user_id, after_id)).fetchall()
+
+    def subscribe(self, user_id, subscription=None):
+        # anything with put(row) that the poll thread can call, a queue.Queue by default
+        subscription = subscription or queue.Queue()
+        with self.lock:
+            if not self.subscribers:
+                self.last_id = self.latest_id()
+            self.subscribers.setdefault(user_id, set()).add(subscription)
+            if self.thread_pid != os.getpid():
+                self.thread = threading.Thread(target=self.poll, name="inbox-hub", daemon=True)
+                self.thread_pid = os.getpid()
+                self.thread.start()
+        return subscription
+
+    def unsubscribe(self, user_id, subscription):
+        with self.lock:
+            subscriptions = self.subscribers.get(user_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self.subscribers.pop(user_id, None)
+
+    def poll(self):
+        last_prune = 0
+        while True:
+            time.sleep(POLL_SECONDS)
+            with self.lock:
+                if not self.subscribers:
+                    continue
+            try:
+                rows = self.connection().execute("SELECT id, user_id, kind, row_id FROM inbox_events WHERE id > ? "
+                                                 "ORDER BY id", (self.last_id,)).fetchall()
+                if time.time() - last_prune > RETENTION_SECONDS:
+                    self.connection().execute("DELETE FROM inbox_events WHERE created < ?",
+                                              (time.time() - RETENTION_SECONDS,))
+                    last_prune = time.time()
+            except sqlite3.Error:
+                logger.exception("inbox event log is unavailable")
+                continue
+            with self.lock:
+                for row in rows:
+                    for subscription in self.subscribers.get(row[1], ()):
+                        subscription.put(row)
+                if rows:
+                    self.last_id = rows[-1][0]
+
+
+class AsyncSubscription:
+    # hands the rows from the poll thread over to the event loop a stream of the ASGI app waits on
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.rows = asyncio.Queue()
+
+    def put(self, row):
+        try:
+            self.loop.call_soon_threadsafe(self.rows.put_nowait, row)
+        except RuntimeError:
+            pass  # the loop is closed, the server is shutting down
+
+
+hub = InboxHub()
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _collect_inbox_rows(session, flush_context):
+    for instance in session.new:
+        kind = KINDS.get(type(instance))
+        if kind:
+            session.info.setdefault("inbox_events", []).append((instance.receiver_id, kind, instance.id))
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _publish_inbox_rows(session):
+    events = session.info.pop("inbox_events", None)
+    if events and hub.path:
+        try:
+            hub.publish(events)
+        except sqlite3.Error:
+            # the rows are committed, subscribers will see them on their next page load
+            logger.exception("could not publish %s inbox events", len(events))
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _discard_inbox_rows(session):
+    session.info.pop("inbox_events", None)
+
+
+def format_event(name, data, event_id=None):
+    lines = ["id: {}".format(event_id)] if event_id is not None else []
+    lines.append("event: " + name)
+    lines.extend("data: " + line for line in data.strip().splitlines() or [""])
+    return "\n".join(lines) + "\n\n"
+
+
+def stream(user_id, last_event_id, render):
+    # render(events) -> [(event name, data)]; Last-Event-ID lets a reconnecting browser catch up from the log
+    if not hub.stream_slots.acquire(blocking=False):
+        yield from poll(user_id, last_event_id, render)
+        return
+    try:
+        yield from live_stream(user_id, last_event_id, render)
+    finally:
+        hub.stream_slots.release()
+
+
+def poll(user_id, last_event_id, render):
+    # the events since Last-Event-ID and a late reconnect, so the thread is free again right away
+    yield "retry: {}\n\n".format(BUSY_RETRY_MS)
+    if last_event_id is None:
+        # an id without data only sets the browser's Last-Event-ID, its reconnect catches up from here
+        yield "id: {}\n\n".format(hub.latest_id())
+        return
+    events = hub.replay(user_id, last_event_id)
+    if events:
+        for name, data in render(events):
+            yield format_event(name, data, events[-1][0])
+
+
+def live_stream(user_id, last_event_id, render):
+    subscription = hub.subscribe(user_id)
+    try:
+        backlog = hub.replay(user_id, last_event_id) if last_event_id is not None else []
+        yield "retry: 3000\n\n"
+        started = last_write = time.monotonic()
+        seen = last_event_id or 0
+        while time.monotonic() - started < STREAM_SECONDS:
+            events = backlog
+            backlog = []
+            wait = min(HEARTBEAT_SECONDS, max(0.0, STREAM_SECONDS - (time.monotonic() - started)))
+            try:
+                while True:
+                    events.append(subscription.get(timeout=wait if not events else 0))
+            except queue.Empty:
+                pass
+            # the replayed backlog and the live feed can overlap
+            events = [row for row in events if row[0] > seen]
+            if events:
+                seen = events[-1][0]
+                for name, data in render(events):
+                    yield format_event(name, data, events[-1][0])
+                last_write = time.monotonic()
+            elif time.monotonic() - last_write >= HEARTBEAT_SECONDS:
+                yield ": keep-alive\n\n"
+                last_write = time.monotonic()
+    finally:
+        hub.unsubscribe(user_id, subscription)
+
+
+async def async_stream(user_id, last_event_id, render):
+    # stream() for the ASGI app, render(events) is a coroutine; a waiting stream holds no thread
+    subscription = AsyncSubscription()
+    hub.subscribe(user_id, subscription)
+    try:
+        backlog = await asyncio.to_thread(hub.replay, user_id, last_event_id) if last_event_id is not None else []
+        yield "retry: 3000\n\n"
+        started = last_write = time.monotonic()
+        seen = last_event_id or 0
+        while time.monotonic() - started < STREAM_SECONDS:
+            events = backlog
+            backlog = []
+            wait = min(HEARTBEAT_SECONDS, max(0.0, STREAM_SECONDS - (time.monotonic() - started)))
+            try:
+                if not events:
+                    events.append(await asyncio.wait_for(subscription.rows.get(), wait))
+                while True:
+                    events.append(subscription.rows.get_nowait())
+            except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                pass
+            events = [row for row in events if row[0] > seen]
+            if events:
+                seen = events[-1][0]
+                for name, data in await render(events):
+                    yield format_event(name, data, events[-1][0])
+                last_write = time.monotonic()
+            elif time.monotonic() - last_write >= HEARTBEAT_SECONDS:
+                yield ": keep-alive\n\n"
+                last_write = time.monotonic()
+    finally:
+        hub.unsubscribe(user_id, subscription)
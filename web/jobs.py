@@ -0,0 +1,187 @@
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "5"))
+RETRY_BASE_SECONDS = float(os.environ.get("JOB_RETRY_BASE_SECONDS", "2"))
+LEASE_SECONDS = 60
+POLL_SECONDS = 1.0
+DRAIN_SECONDS = float(os.environ.get("JOB_DRAIN_SECONDS", "10"))
+WORKER_THREAD = os.environ.get("JOB_WORKER_THREAD", "True") == "True"
+
+HANDLERS = {}
+SCHEDULES = {}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_at REAL NOT NULL,
+    claimed_until REAL,
+    failed INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_jobs_due ON jobs (failed, run_at);
+CREATE TABLE IF NOT EXISTS schedules (
+    name TEXT PRIMARY KEY,
+    next_run REAL NOT NULL
+);
+"""
+
+
+def job(name):
+    def decorator(function):
+        HANDLERS[name] = function
+        return function
+    return decorator
+
+
+def schedule(name, every):
+    # the job is enqueued every `every` seconds by whichever worker notices first
+    SCHEDULES[name] = every
+
+
+class JobQueue:
+    # durable queue in a local SQLite file, shared by every worker process on the host;
+    # a job is claimed for LEASE_SECONDS, so the job of a crashed worker runs again later (at least once delivery)
+    def __init__(self):
+        self.app = None
+        self.path = None
+        self.local = threading.local()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.thread_pid = None
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.path = os.environ.get("JOB_QUEUE_PATH") or os.path.join(app.instance_path, "jobs.db")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self.connection() as connection:
+            connection.executescript(SCHEMA)
+            connection.executemany("INSERT OR IGNORE INTO schedules (name, next_run) VALUES (?, 0)",
+                                   [(name,) for name in SCHEDULES])
+        if WORKER_THREAD:
+            app.before_request(self.start)
+        atexit.register(self.shutdown)
+
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection, self.local.pid = connection, os.getpid()
+        return connection
+
+    def enqueue(self, name, **payload):
+        if name not in HANDLERS:
+            raise KeyError("no handler registered for job {}".format(name))
+        self.connection().execute("INSERT INTO jobs (name, payload, run_at) VALUES (?, ?, ?)",
+                                  (name, json.dumps(payload), time.time()))
+        self.wakeup.set()
+
+    def enqueue_scheduled(self):
+        now = time.time()
+        connection = self.connection()
+        for name, every in SCHEDULES.items():
+            row = connection.execute("SELECT next_run FROM schedules WHERE name = ?", (name,)).fetchone()
+            if row is None or row[0] > now:
+                continue
+            # only the worker whose update wins enqueues this round
+            claimed = connection.execute("UPDATE schedules SET next_run = ? WHERE name = ? AND next_run = ?",
+                                         (now + every, name, row[0])).rowcount
+            if claimed:
+                self.enqueue(name)
+
+    def claim(self):
+        now = time.time()
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT id, name, payload, attempts FROM jobs "
+                "WHERE failed = 0 AND run_at <= ? AND (claimed_until IS NULL OR claimed_until < ?) "
+                "ORDER BY run_at, id LIMIT 1", (now, now)).fetchone()
+            if row:
+                connection.execute("UPDATE jobs SET claimed_until = ?, attempts = attempts + 1 WHERE id = ?",
+                                   (now + LEASE_SECONDS, row[0]))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return row
+
+    def run_one(self):
+        row = self.claim()
+        if row is None:
+            return False
+        job_id, name, payload, attempts = row
+        attempts += 1
+        try:
+            with self.app.app_context():
+                HANDLERS[name](**json.loads(payload))
+        except Exception as e:
+            if attempts >= MAX_ATTEMPTS:
+                logger.exception("job %s #%s failed for good after %s attempts", name, job_id, attempts)
+                self.connection().execute("UPDATE jobs SET failed = 1, claimed_until = NULL, last_error = ? "
+                                          "WHERE id = ?", (repr(e), job_id))
+            else:
+                delay = RETRY_BASE_SECONDS * 2 ** (attempts - 1)
+                logger.warning("job %s #%s failed (attempt %s), retrying in %.0fs: %r", name, job_id, attempts, delay, e)
+                self.connection().execute("UPDATE jobs SET run_at = ?, claimed_until = NULL, last_error = ? "
+                                          "WHERE id = ?", (time.time() + delay, repr(e), job_id))
+        else:
+            self.connection().execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        return True
+
+    def start(self):
+        # threads do not survive a fork, every gunicorn worker starts its own on its first request
+        if self.thread_pid == os.getpid() or self.stopping.is_set():
+            return
+        with self.lock:
+            if self.thread_pid != os.getpid():
+                self.thread = threading.Thread(target=self.work, name="job-queue", daemon=True)
+                self.thread_pid = os.getpid()
+                self.thread.start()
+
+    def work(self):
+        while not self.stopping.is_set():
+            try:
+                if self.run_one():
+                    continue
+                self.enqueue_scheduled()
+            except sqlite3.Error:
+                logger.exception("job queue is unavailable")
+            self.wakeup.wait(POLL_SECONDS)
+            self.wakeup.clear()
+
+    def drain(self, timeout=DRAIN_SECONDS):
+        # runs the jobs that are due now, a job retried with backoff stays in the file for the next process
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and self.run_one():
+            pass
+
+    def shutdown(self):
+        if self.app is None or self.stopping.is_set():
+            return
+        self.stopping.set()
+        self.wakeup.set()
+        if self.thread is not None and self.thread_pid == os.getpid():
+            self.thread.join(DRAIN_SECONDS)
+        self.drain()
+
+    def pending(self):
+        return self.connection().execute("SELECT count(*) FROM jobs WHERE failed = 0").fetchone()[0]
+
+
+queue = JobQueue()
@@ -0,0 +1,77 @@
+import hashlib
+import hmac
+import os
+
+import pyscrypt
+
+
+SCRYPT_N = 2048
+SCRYPT_R = 8
+SCRYPT_P = 1
+SCRYPT_DKLEN = 128
+
+HASH_SCHEME = "scrypt"
+HASH_VERSION = 1
+
+
+class NativeScrypt:
+    name = "native"
+
+    def derive(self, password: bytes, salt: bytes, n: int, r: int, p: int, dklen: int) -> bytes:
+        # OpenSSL releases the GIL while hashing, so threaded workers hash in parallel
+        return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p, dklen=dklen, maxmem=256 * n * r + 1024 * 1024)
+
+
+class PyScrypt:
+    name = "pyscrypt"
+
+    def derive(self, password: bytes, salt: bytes, n: int, r: int, p: int, dklen: int) -> bytes:
+        return bytes(pyscrypt.hash(password, salt, n, r, p, dklen))
+
+
+BACKENDS = {backend.name: backend for backend in (NativeScrypt(), PyScrypt())}
+
+
+def native_available():
+    return hasattr(hashlib, "scrypt")
+
+
+def get_backend(name=None):
+    name = name or os.environ.get("KDF_BACKEND")
+    if name is None:
+        name = NativeScrypt.name if native_available() else PyScrypt.name
+    if name not in BACKENDS:
+        raise ValueError("Unknown KDF backend: " + name)
+    return BACKENDS[name]
+
+
+_backend = get_backend()
+
+
+def derive(password: bytes, salt: bytes, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P, dklen=SCRYPT_DKLEN):
+    return _backend.derive(password, salt, n, r, p, dklen)
+
+
+def encode(digest: bytes, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    return "${}${}$n={},r={},p={}${}".format(HASH_SCHEME, HASH_VERSION, n, r, p, digest.hex())
+
+
+def decode(stored):
+    # hashes stored before versioning are raw 128-byte pyscrypt digests with the default parameters
+    if isinstance(stored, (bytes, bytearray, memoryview)):
+        return 0, SCRYPT_N, SCRYPT_R, SCRYPT_P, bytes(stored)
+    _, scheme, version, params, digest = stored.split("$")
+    if scheme != HASH_SCHEME:
+        raise ValueError("Unknown hash scheme: " + scheme)
+    params = dict(param.split("=") for param in params.split(","))
+    return int(version), int(params["n"]), int(params["r"]), int(params["p"]), bytes.fromhex(digest)
+
+
+def verify(password: bytes, salt: bytes, stored):
+    version, n, r, p, digest = decode(stored)
+    return hmac.compare_digest(derive(password, salt, n, r, p, len(digest)), digest)
+
+
+def needs_rehash(stored):
+    version, n, r, p, digest = decode(stored)
+    return version != HASH_VERSION or (n, r, p, len(digest)) != (SCRYPT_N, SCRYPT_R, SCRYPT_P, SCRYPT_DKLEN)
@@ -0,0 +1,200 @@
+import csv
+import io
+import json
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy import or_, select
+from sqlalchemy.orm import aliased
+
+import web.security_utils as su
+from web.models.balance_models import bump_generations
+from web.models.db_init import db
+from web.models.loan_models import Loan, LoanLog, LoanMessage, LoanStatus, LoanLogType, MessageType, \
+    OUTSTANDING_STATUSES, apply_balance_changes
+from web.models.user_models import User
+
+
+FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+LOAN_FIELDS = ["id", "lender", "borrower", "amount", "deadline", "status", "timestamp"]
+LOG_FIELDS = ["id", "loan_id", "lender", "borrower", "status", "timestamp", "message"]
+IMPORT_FIELDS = ["lender", "borrower", "amount", "deadline"]
+# looked up as usernames and a status name, an NDJSON row could hold a list or an object there
+TEXT_FIELDS = ["lender", "borrower", "status"]
+STREAM_CHUNK_ROWS = 1000
+IMPORT_BATCH_SIZE = 500
+MAX_REPORTED_ERRORS = 100
+
+# audit trail written for a loan imported with a given status
+IMPORT_HISTORY = {
+    LoanStatus.REQUEST_IN_PROGRESS: [(LoanStatus.REQUEST_IN_PROGRESS, LoanLogType.REQUEST)],
+    LoanStatus.NOT_PAYED: [(LoanStatus.REQUEST_IN_PROGRESS, LoanLogType.REQUEST),
+                           (LoanStatus.NOT_PAYED, LoanLogType.REQUEST_ACCEPTED)],
+    LoanStatus.PENDING: [(LoanStatus.REQUEST_IN_PROGRESS, LoanLogType.REQUEST),
+                         (LoanStatus.NOT_PAYED, LoanLogType.REQUEST_ACCEPTED),
+                         (LoanStatus.PENDING, LoanLogType.REPAY)],
+    LoanStatus.PAYED: [(LoanStatus.REQUEST_IN_PROGRESS, LoanLogType.REQUEST),
+                       (LoanStatus.NOT_PAYED, LoanLogType.REQUEST_ACCEPTED),
+                       (LoanStatus.PENDING, LoanLogType.REPAY),
+                       (LoanStatus.PAYED, LoanLogType.REPAY_ACCEPTED)],
+    LoanStatus.CANCELED: [(LoanStatus.REQUEST_IN_PROGRESS, LoanLogType.REQUEST),
+                          (LoanStatus.CANCELED, LoanLogType.REQUEST_REJECTED)],
+}
+# message the lender still has to answer for a loan imported with a given status
+IMPORT_OPEN_MESSAGES = {
+    LoanStatus.REQUEST_IN_PROGRESS: MessageType.NEW_LOAN,
+    LoanStatus.PENDING: MessageType.REPAYMENT,
+}
+
+
+class ImportResult:
+    def __init__(self):
+        self.imported = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, line_number, reason):
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append("line {}: {}".format(line_number, reason))
+
+
+def serialize(rows, fields, fmt):
+    # yields text in chunks of STREAM_CHUNK_ROWS rows, so memory use does not depend on the ledger size
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == "csv":
+        writer.writerow(fields)
+    for count, row in enumerate(rows, 1):
+        if fmt == "csv":
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(fields, row))) + "\n")
+        if count % STREAM_CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _party_filter(model, user):
+    return or_(model.lender_id == user.id, model.borrower_id == user.id)
+
+
+def export_loans(fmt, user: User = None):
+    lender, borrower = aliased(User), aliased(User)
+    query = (
+        select(Loan.id, lender.username, borrower.username, Loan.amount, Loan.deadline, Loan.status, Loan.timestamp)
+        .join(lender, Loan.lender_id == lender.id)
+        .join(borrower, Loan.borrower_id == borrower.id)
+        .order_by(Loan.id)
+    )
+    if user:
+        query = query.where(_party_filter(Loan, user))
+    rows = db.session.execute(query.execution_options(yield_per=STREAM_CHUNK_ROWS))
+    return serialize(((id, lender, borrower, amount, deadline.isoformat(), LoanStatus(status).name,
+                       timestamp.isoformat() if timestamp else None)
+                      for id, lender, borrower, amount, deadline, status, timestamp in rows), LOAN_FIELDS, fmt)
+
+
+def export_loan_logs(fmt, user: User = None):
+    lender, borrower = aliased(User), aliased(User)
+    query = (
+        select(LoanLog.id, LoanLog.loan_id, lender.username, borrower.username, LoanLog.status, LoanLog.timestamp,
+               LoanLog.message)
+        .join(lender, LoanLog.lender_id == lender.id)
+        .join(borrower, LoanLog.borrower_id == borrower.id)
+        .order_by(LoanLog.id)
+    )
+    if user:
+        query = query.where(_party_filter(LoanLog, user))
+    rows = db.session.execute(query.execution_options(yield_per=STREAM_CHUNK_ROWS))
+    return serialize(((id, loan_id, lender, borrower, LoanStatus(status).name, timestamp.isoformat(), message)
+                      for id, loan_id, lender, borrower, status, timestamp, message in rows), LOG_FIELDS, fmt)
+
+
+def read_rows(lines, fmt):
+    if fmt == "csv":
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_number, row if isinstance(row, dict) else None
+
+
+def import_loans(lines, fmt, borrower: User = None, batch_size=IMPORT_BATCH_SIZE):
+    # with a borrower (web import) every row must be that user's own request, like on /new-loan;
+    # without one (CLI) rows may name any borrower and an optional status
+    result = ImportResult()
+    users = {}
+    batch = []
+
+    def find_user(username):
+        if username not in users:
+            users[username] = User.query.filter_by(username=username).first()
+        return users[username]
+
+    for line_number, row in read_rows(lines, fmt):
+        if row is None or any(row.get(field) in (None, "") for field in IMPORT_FIELDS):
+            result.reject(line_number, "expected fields " + ", ".join(IMPORT_FIELDS))
+            continue
+        if any(row.get(field) is not None and not isinstance(row[field], str) for field in TEXT_FIELDS):
+            result.reject(line_number, ", ".join(TEXT_FIELDS) + " must be strings")
+            continue
+        amount, deadline = str(row["amount"]), str(row["deadline"])
+        if not su.validate_new_loan(deadline, amount):
+            result.reject(line_number, "invalid loan data")
+            continue
+        if borrower and row["borrower"] != borrower.username:
+            result.reject(line_number, "you can only import your own loans")
+            continue
+        status = LoanStatus.REQUEST_IN_PROGRESS
+        if not borrower and row.get("status"):
+            if row["status"] not in LoanStatus.__members__:
+                result.reject(line_number, "unknown status " + str(row["status"]))
+                continue
+            status = LoanStatus[row["status"]]
+        lender, row_borrower = find_user(row["lender"]), borrower or find_user(row["borrower"])
+        if not lender or not row_borrower:
+            result.reject(line_number, "no such user")
+            continue
+
+        batch.append((lender, row_borrower, float(amount), datetime.strptime(deadline, "%Y-%m-%d"), status))
+        if len(batch) >= batch_size:
+            result.imported += insert_batch(batch)
+            batch = []
+    if batch:
+        result.imported += insert_batch(batch)
+    return result
+
+
+def insert_batch(rows):
+    objects = []
+    balance_changes = defaultdict(float)
+    for lender, borrower, amount, deadline, status in rows:
+        loan = Loan(lender, borrower, amount, deadline)
+        objects.append(loan)
+        for step_status, log_type in IMPORT_HISTORY[status]:
+            loan.status = step_status.value
+            objects.append(LoanLog(loan, log_type))
+        if status in IMPORT_OPEN_MESSAGES:
+            objects.append(LoanMessage(loan, lender.id, IMPORT_OPEN_MESSAGES[status]))
+        if loan.status in OUTSTANDING_STATUSES:
+            balance_changes[(lender.id, borrower.id)] += amount
+
+    db.session.add_all(objects)
+    if balance_changes:
+        apply_balance_changes(balance_changes)
+    bump_generations({user.id for lender, borrower, *_ in rows for user in (lender, borrower)})
+    db.session.commit()
+    # keep the session's identity map from growing with the import
+    for obj in objects:
+        db.session.expunge(obj)
+    return len(rows)
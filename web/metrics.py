@@ -0,0 +1,252 @@
+import logging
+import os
+import secrets
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+from flask import g, request, has_request_context, abort, Response
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from web.template_cache import fragments
+from web.user_agent_cache import cache_stats
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SQL_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+ADMIN_USERS = frozenset(filter(None, os.environ.get("ADMIN_USERS", "").split(",")))
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+SLOW_REQUEST_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS", "0"))
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+
+
+class Registry:
+    # samples of this worker process only, every series carries its pid so scrapes of different workers can be told apart
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.help = {}
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def render(self, extra_samples=()):
+        pid = str(os.getpid())
+        lines, described = [], set()
+
+        def header(name):
+            if name not in described and name in self.help:
+                kind, text = self.help[name]
+                lines.append("# HELP {} {}".format(name, text))
+                lines.append("# TYPE {} {}".format(name, kind))
+                described.add(name)
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(h.buckets), list(h.counts), h.sum)) for key, h in self.histograms.items())
+        for (name, labels), value in list(counters) + list(extra_samples):
+            header(name)
+            lines.append("{}{} {}".format(name, format_labels(labels, pid=pid), value))
+        for (name, labels), (buckets, counts, total) in histograms:
+            header(name)
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ["+Inf"], counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(name, format_labels(labels, pid=pid, le=bound), cumulative))
+            lines.append("{}_sum{} {}".format(name, format_labels(labels, pid=pid), total))
+            lines.append("{}_count{} {}".format(name, format_labels(labels, pid=pid), cumulative))
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    escaped = ('{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"')) for key, value in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+
+registry = Registry()
+registry.describe("http_request_duration_seconds", "histogram", "Time from request start to response, per endpoint.")
+registry.describe("http_requests_total", "counter", "Responses per endpoint and status.")
+registry.describe("sql_statements_total", "counter", "SQL statements executed while serving an endpoint.")
+registry.describe("sql_statement_duration_seconds", "histogram", "Execution time of single SQL statements.")
+registry.describe("sql_commits_total", "counter", "Transactions committed while serving an endpoint.")
+registry.describe("sql_errors_total", "counter", "SQL statements that failed while serving an endpoint.")
+registry.describe("password_hash_duration_seconds", "histogram", "Time spent deriving scrypt password hashes.")
+registry.describe("response_deadline_wait_seconds", "histogram", "Time parked until an equalized response deadline.")
+registry.describe("response_deadline_busy_total", "counter", "Requests refused while every deadline slot was taken.")
+registry.describe("user_agent_cache_lookups_total", "counter", "Parsed user agent cache lookups by result.")
+registry.describe("app_create_seconds", "histogram", "Time create_app took, in the master when preloading.")
+registry.describe("worker_boot_seconds", "histogram", "Time from the fork of a gunicorn worker until it serves.")
+registry.describe("fragment_cache_lookups_total", "counter", "Rendered fragment cache lookups by result.")
+
+
+@contextmanager
+def timed(name, buckets=LATENCY_BUCKETS, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe(name, time.perf_counter() - start, buckets, **labels)
+
+
+def current_endpoint():
+    if has_request_context():
+        return request.endpoint or "unmatched"
+    return "none"
+
+
+# the start time is kept on the statement's execution context, which a failed statement takes with it,
+# not on the pooled connection
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.metrics_started = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "metrics_started", None)
+    if started is None:
+        return
+    endpoint = current_endpoint()
+    registry.inc("sql_statements_total", endpoint=endpoint)
+    registry.observe("sql_statement_duration_seconds", time.perf_counter() - started, SQL_BUCKETS, endpoint=endpoint)
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(exception_context):
+    context = exception_context.execution_context
+    if getattr(context, "metrics_started", None) is not None:
+        context.metrics_started = None
+        registry.inc("sql_errors_total", endpoint=current_endpoint())
+
+
+@event.listens_for(Engine, "commit")
+def _commit(conn):
+    registry.inc("sql_commits_total", endpoint=current_endpoint())
+
+
+class SlowRequestWatchdog:
+    # one thread samples the stacks of requests running longer than the threshold, instead of a timer per request
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.running = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self, endpoint):
+        with self.lock:
+            self.running[threading.get_ident()] = [time.monotonic(), endpoint, False]
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.watch, name="slow-request-watchdog", daemon=True)
+                self.thread.start()
+
+    def finish(self):
+        with self.lock:
+            entry = self.running.pop(threading.get_ident(), None)
+        if entry and entry[2]:
+            logger.warning("slow request %s finished after %.3fs", entry[1], time.monotonic() - entry[0])
+
+    def watch(self):
+        while True:
+            time.sleep(self.threshold / 2)
+            now = time.monotonic()
+            with self.lock:
+                slow = [(ident, entry) for ident, entry in self.running.items()
+                        if not entry[2] and now - entry[0] >= self.threshold]
+                for _, entry in slow:
+                    entry[2] = True
+            frames = sys._current_frames()
+            for ident, (started, endpoint, _) in slow:
+                frame = frames.get(ident)
+                if frame is not None:
+                    logger.warning("slow request %s running for %.3fs, sampled stack:\n%s", endpoint, now - started,
+                                   "".join(traceback.format_stack(frame)))
+
+
+watchdog = SlowRequestWatchdog(SLOW_REQUEST_SECONDS) if SLOW_REQUEST_SECONDS > 0 else None
+
+
+def user_agent_samples():
+    stats = cache_stats()
+    return [(("user_agent_cache_lookups_total", (("result", "hit"),)), stats["hits"]),
+            (("user_agent_cache_lookups_total", (("result", "miss"),)), stats["misses"])]
+
+
+def fragment_samples():
+    return [(("fragment_cache_lookups_total", (("result", "hit"),)), fragments.hits),
+            (("fragment_cache_lookups_total", (("result", "miss"),)), fragments.misses)]
+
+
+def render():
+    return registry.render(user_agent_samples() + fragment_samples())
+
+
+def is_metrics_reader():
+    authorization = request.headers.get("Authorization", "")
+    if METRICS_TOKEN and authorization.startswith("Bearer "):
+        return secrets.compare_digest(authorization[len("Bearer "):], METRICS_TOKEN)
+    return current_user.is_authenticated and current_user.username in ADMIN_USERS
+
+
+def init_app(app):
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+        if watchdog:
+            watchdog.start(current_endpoint())
+
+    @app.after_request
+    def record_response(response):
+        if "metrics_started" in g:
+            endpoint = current_endpoint()
+            registry.observe("http_request_duration_seconds", time.perf_counter() - g.metrics_started,
+                             endpoint=endpoint, method=request.method)
+            registry.inc("http_requests_total", endpoint=endpoint, method=request.method, status=response.status_code)
+        return response
+
+    @app.teardown_request
+    def finish_request(exc):
+        if watchdog:
+            watchdog.finish()
+
+    @app.route("/metrics")
+    def metrics_endpoint():
+        if not is_metrics_reader():
+            abort(404)
+        return Response(render(), mimetype=CONTENT_TYPE)
@@ -0,0 +1,49 @@
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from web.storage import POOL_OPTIONS, POSTGRES_POOL_OPTIONS, set_sqlite_pragmas
+from web.models.db_init import db
+from web.models.model_handler import unresolved_messages_count, inbox_rows
+from web.models.user_models import User
+
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}
+
+
+class AsyncDatabase:
+    # second engine on the same database for the views served natively by the ASGI app,
+    # the statements are the ones model_handler runs through the Flask-SQLAlchemy session
+    def __init__(self):
+        self.engine = None
+        self.sessions = None
+
+    def init_app(self, app):
+        with app.app_context():
+            # a relative SQLite path is already resolved against the instance folder here
+            url = db.engine.url
+        backend = url.get_backend_name()
+        options = {}
+        if backend == "postgresql":
+            options = dict(POSTGRES_POOL_OPTIONS)
+        elif url.database and url.database != ":memory:":
+            options = dict(POOL_OPTIONS, poolclass=AsyncAdaptedQueuePool)
+        self.engine = create_async_engine(url.set(drivername=ASYNC_DRIVERS[backend]), **options)
+        if backend == "sqlite":
+            event.listen(self.engine.sync_engine, "connect", lambda dbapi_connection, record:
+                         set_sqlite_pragmas(dbapi_connection))
+        self.sessions = async_sessionmaker(self.engine, expire_on_commit=False)
+
+
+async def find_user(session, username):
+    return await session.scalar(select(User).filter_by(username=username))
+
+
+async def count_unresolved_messages(session, user: User):
+    return await session.scalar(unresolved_messages_count(user))
+
+
+async def get_inbox_rows(session, user: User, model, ids):
+    return (await session.scalars(inbox_rows(user, model, ids))).all()
+
+
+database = AsyncDatabase()
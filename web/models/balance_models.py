@@ -0,0 +1,71 @@
+from flask import g
+from sqlalchemy.dialects import postgresql, sqlite
+
+from web.models.db_init import db
+
+
+# amounts are floats, anything below half a grosz is a rounding leftover of a settled balance
+SETTLED_EPSILON = 0.005
+
+
+class UserBalance(db.Model):
+    __tablename__ = 'user_balances'
+    __table_args__ = (
+        db.Index('ix_user_balances_debt', 'debt'),
+    )
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True, autoincrement=False)
+    debt = db.Column(db.Float, nullable=False, default=0)
+    credit = db.Column(db.Float, nullable=False, default=0)
+    # outstanding loans of this user marked overdue by the periodic scan
+    overdue_count = db.Column(db.Integer, nullable=False, default=0)
+
+    @property
+    def overdue(self):
+        return self.overdue_count > 0
+
+
+class PairBalance(db.Model):
+    __tablename__ = 'pair_balances'
+    __table_args__ = (
+        db.Index('ix_pair_balances_borrower', 'borrower_id'),
+    )
+    lender_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True, autoincrement=False)
+    borrower_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True, autoincrement=False)
+    amount = db.Column(db.Float, nullable=False, default=0)
+
+
+class LedgerGeneration(db.Model):
+    __tablename__ = 'ledger_generations'
+    # a user id, or GLOBAL_GENERATION for the generation of all balances together
+    scope = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    generation = db.Column(db.Integer, nullable=False, default=0)
+
+
+GLOBAL_GENERATION = 0
+
+
+def increment(model, keys, increments):
+    # single upsert, so concurrent transitions of the same user never lose an update
+    dialect = db.session.get_bind().dialect.name
+    insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+    statement = insert(model).values(**keys, **increments)
+    statement = statement.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={column: getattr(model, column) + getattr(statement.excluded, column) for column in increments}
+    )
+    db.session.execute(statement)
+
+
+def bump_generations(user_ids):
+    # in the transaction that changes the balances; sorted, so concurrent bumps lock the rows in the same order
+    for scope in sorted({GLOBAL_GENERATION, *user_ids}):
+        increment(LedgerGeneration, {"scope": scope}, {"generation": 1})
+    g.pop("ledger_generations", None)
+
+
+def ledger_generation(scope):
+    # read once per request, the ETag and the cached fragments of a page use the same generation
+    generations = g.setdefault("ledger_generations", {})
+    if scope not in generations:
+        generations[scope] = db.session.query(LedgerGeneration.generation).filter_by(scope=scope).scalar() or 0
+    return generations[scope]
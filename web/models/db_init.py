@@ -1,3 +1,5 @@
 from flask_sqlalchemy import SQLAlchemy
 
-db = SQLAlchemy(disable_autonaming=True)
+from web.storage import RoutingSession
+
+db = SQLAlchemy(disable_autonaming=True, session_options={"class_": RoutingSession})
@@ -0,0 +1,74 @@
+import os
+import secrets
+import threading
+import time
+
+from flask import g
+
+
+IDENTITY_CACHE_TTL = float(os.environ.get("IDENTITY_CACHE_TTL", "5"))
+
+
+class TTLCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            return None
+        return entry[0]
+
+    def set(self, key, value):
+        now = time.monotonic()
+        with self._lock:
+            # re-inserted at the end, so with a single ttl the entries stay in expiry order
+            self._entries.pop(key, None)
+            self._entries[key] = (value, now + self.ttl)
+            # expired entries are dropped from the front, the cache holds only the users of the last ttl seconds
+            while True:
+                oldest = next(iter(self._entries))
+                if self._entries[oldest][1] >= now:
+                    break
+                del self._entries[oldest]
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+# per worker process; other workers see changes after at most IDENTITY_CACHE_TTL seconds
+users = TTLCache(IDENTITY_CACHE_TTL)
+tokens = TTLCache(IDENTITY_CACHE_TTL)
+
+
+def csrf_token(user):
+    if g.get("csrf_token") is None:
+        token = tokens.get(user.id)
+        if token is None:
+            last_login = user.last_login()
+            token = last_login.token if last_login else None
+            tokens.set(user.id, token)
+        g.csrf_token = token
+    return g.csrf_token
+
+
+def csrf_token_is_valid(user, form_token):
+    token = csrf_token(user)
+    if token != form_token:
+        # the cached token may predate a login handled by another worker
+        forget_token(user.id)
+        token = csrf_token(user)
+    return token is not None and secrets.compare_digest(token.encode("utf8"), form_token.encode("utf8"))
+
+
+def remember_token(user_id, token):
+    tokens.set(user_id, token)
+    g.pop("csrf_token", None)
+
+
+def forget_token(user_id):
+    tokens.invalidate(user_id)
+    g.pop("csrf_token", None)
@@ -1,6 +1,9 @@
 from datetime import datetime
 from enum import Enum
 
+from sqlalchemy import delete, update
+
+from web.models.balance_models import UserBalance, PairBalance, SETTLED_EPSILON, increment, bump_generations
 from web.models.db_init import db
 from web.models.user_models import User
 
@@ -13,6 +16,9 @@ class LoanStatus(Enum):
     CANCELED = 5
 
 
+OUTSTANDING_STATUSES = (LoanStatus.NOT_PAYED.value, LoanStatus.PENDING.value)
+
+
 class MessageType(Enum):
     NEW_LOAN = "{full_name} ({username}) wants to borrow {amount} from you, until {deadline}. Do you accept?"
     REPAYMENT = "{full_name} ({username}) claims to repay {amount} to you. Do you accept?"
@@ -29,61 +35,107 @@ class LoanLogType(Enum):
 
 class Loan(db.Model):
     __tablename__ = 'loans'
+    __table_args__ = (
+        db.Index('ix_loans_lender_status', 'lender_id', 'status'),
+        db.Index('ix_loans_borrower_status', 'borrower_id', 'status'),
+        db.Index('ix_loans_lender_timestamp', 'lender_id', 'timestamp', 'id'),
+        db.Index('ix_loans_borrower_timestamp', 'borrower_id', 'timestamp', 'id'),
+        db.Index('ix_loans_status_overdue_deadline', 'status', 'overdue', 'deadline'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     lender_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     borrower_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     amount = db.Column(db.Float, nullable=False)
     deadline = db.Column(db.Date(), nullable=False)
     status = db.Column(db.Integer, nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)
+    overdue = db.Column(db.Boolean, nullable=False, default=False)
 
-    def __init__(self, lender_id, borrower_id, amount, deadline):
-        self.lender_id = lender_id
-        self.borrower_id = borrower_id
+    lender = db.relationship(User, foreign_keys=[lender_id], lazy="joined")
+    borrower = db.relationship(User, foreign_keys=[borrower_id], lazy="joined")
+
+    def __init__(self, lender: User, borrower: User, amount, deadline):
+        self.lender_id = lender.id
+        self.borrower_id = borrower.id
+        self.lender = lender
+        self.borrower = borrower
         self.amount = amount
         self.deadline = deadline
         self.status = LoanStatus.REQUEST_IN_PROGRESS.value
+        self.timestamp = datetime.now()
+        self.overdue = False
 
     def add_to_db(self):
         db.session.add(self)
+        db.session.add(LoanLog(self, LoanLogType.REQUEST))
+        db.session.add(LoanMessage(self, self.lender_id, MessageType.NEW_LOAN))
+        bump_generations([self.lender_id, self.borrower_id])
         db.session.commit()
-        self.log_change(LoanLogType.REQUEST)
-        message = LoanMessage(self.id, self.lender_id, MessageType.NEW_LOAN)
-        message.add_to_db()
 
-    def accept_request(self):
-        self.status = LoanStatus.NOT_PAYED.value
-        db.session.commit()
-        self.log_change(LoanLogType.REQUEST_ACCEPTED)
+    def accept_request(self, answered: "LoanMessage" = None):
+        self.transition(LoanStatus.NOT_PAYED, LoanLogType.REQUEST_ACCEPTED, answered=answered)
 
-    def reject_request(self):
-        self.status = LoanStatus.CANCELED.value
-        db.session.commit()
-        self.log_change(LoanLogType.REQUEST_REJECTED)
+    def reject_request(self, answered: "LoanMessage" = None):
+        self.transition(LoanStatus.CANCELED, LoanLogType.REQUEST_REJECTED, answered=answered)
 
     def pay_back(self):
-        self.status = LoanStatus.PENDING.value
-        db.session.commit()
-        self.log_change(LoanLogType.REPAY)
-        message = LoanMessage(self.id, self.lender_id, MessageType.REPAYMENT)
-        message.add_to_db()
-
-    def confirm_repayment(self):
-        self.status = LoanStatus.PAYED.value
+        self.transition(LoanStatus.PENDING, LoanLogType.REPAY, message_type=MessageType.REPAYMENT)
+
+    def confirm_repayment(self, answered: "LoanMessage" = None):
+        self.transition(LoanStatus.PAYED, LoanLogType.REPAY_ACCEPTED, answered=answered)
+
+    def reject_repayment(self, answered: "LoanMessage" = None):
+        self.transition(LoanStatus.NOT_PAYED, LoanLogType.REPAY_REJECTED, answered=answered)
+
+    def transition(self, status: LoanStatus, log_type: LoanLogType, message_type: MessageType = None,
+                   answered: "LoanMessage" = None):
+        # status, balances, audit log, new message and the answered message are committed together
+        self.change_status(status)
+        db.session.add(LoanLog(self, log_type))
+        if message_type:
+            db.session.add(LoanMessage(self, self.lender_id, message_type))
+        if answered:
+            answered.resolved = True
+        # the pages of both parties show the loan, cached fragments and ETags are keyed by these generations
+        bump_generations([self.lender_id, self.borrower_id])
         db.session.commit()
-        self.log_change(LoanLogType.REPAY_ACCEPTED)
 
-    def reject_repayment(self):
-        self.status = LoanStatus.NOT_PAYED.value
-        db.session.commit()
-        self.log_change(LoanLogType.REPAY_REJECTED)
-
-    def log_change(self, log_type: LoanLogType):
-        log = LoanLog(self.id, self.status, log_type)
-        log.add_to_db()
+    def change_status(self, status: LoanStatus):
+        old_status, self.status = self.status, status.value
+        was_outstanding, is_outstanding = old_status in OUTSTANDING_STATUSES, self.status in OUTSTANDING_STATUSES
+        if was_outstanding != is_outstanding:
+            self.update_balances(float(self.amount) if is_outstanding else -float(self.amount))
+        if was_outstanding and not is_outstanding:
+            self.clear_overdue()
+
+    def clear_overdue(self):
+        # conditional, the overdue scan may have marked the loan after it was loaded
+        cleared = db.session.execute(update(Loan).where(Loan.id == self.id, Loan.overdue.is_(True))
+                                     .values(overdue=False)).rowcount
+        if cleared:
+            increment(UserBalance, {"user_id": self.borrower_id}, {"overdue_count": -1})
+
+    def update_balances(self, amount):
+        apply_balance_changes({(self.lender_id, self.borrower_id): amount})
+
+
+def apply_balance_changes(changes):
+    # changes: {(lender_id, borrower_id): outstanding amount added (or removed when negative)}
+    db.session.flush()
+    for (lender_id, borrower_id), amount in changes.items():
+        increment(PairBalance, {"lender_id": lender_id, "borrower_id": borrower_id}, {"amount": amount})
+        increment(UserBalance, {"user_id": lender_id}, {"credit": amount})
+        increment(UserBalance, {"user_id": borrower_id}, {"debt": amount})
+        db.session.execute(delete(PairBalance).where(PairBalance.lender_id == lender_id,
+                                                     PairBalance.borrower_id == borrower_id,
+                                                     PairBalance.amount < SETTLED_EPSILON))
 
 
 class LoanMessage(db.Model):
     __tablename__ = 'messages'
+    __table_args__ = (
+        db.Index('ix_messages_receiver_resolved_timestamp', 'receiver_id', 'resolved', 'timestamp', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     receiver_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     loan_id = db.Column(db.Integer, db.ForeignKey('loans.id'), nullable=False)
@@ -91,14 +143,14 @@ class LoanMessage(db.Model):
     resolved = db.Column(db.Boolean, nullable=False, default=False)
     timestamp = db.Column(db.DateTime, nullable=False)
     new_loan = db.Column(db.Boolean, nullable=False, default=True)
+    loan = db.relationship(Loan, lazy="joined")
 
-    def __init__(self, loan_id, receiver_id, message_type: MessageType):
-        self.loan_id = loan_id
+    def __init__(self, loan: Loan, receiver_id, message_type: MessageType):
+        self.loan = loan
         self.receiver_id = receiver_id
         self.timestamp = datetime.now()
 
-        loan = Loan.query.filter_by(id=loan_id).first()
-        user = User.query.filter_by(id=loan.borrower_id).first()
+        user = loan.borrower
         if message_type == MessageType.NEW_LOAN:
             self.new_loan = True
             self.message = message_type.value.format(full_name=user.first_name + " " + user.last_name,
@@ -122,20 +174,29 @@ class LoanMessage(db.Model):
 
 class LoanLog(db.Model):
     __tablename__ = 'loan_logs'
+    __table_args__ = (
+        db.Index('ix_loan_logs_loan', 'loan_id'),
+        db.Index('ix_loan_logs_lender_timestamp', 'lender_id', 'timestamp', 'id'),
+        db.Index('ix_loan_logs_borrower_timestamp', 'borrower_id', 'timestamp', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     loan_id = db.Column(db.Integer, db.ForeignKey('loans.id'), nullable=False)
+    # copied from the loan, so each party's log can be paginated by index
+    lender_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    borrower_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     message = db.Column(db.String(), nullable=False)
     status = db.Column(db.Integer, nullable=False)
     timestamp = db.Column(db.DateTime, nullable=False)
+    loan = db.relationship(Loan)
 
-    def __init__(self, loan_id, status, log_type: LoanLogType):
-        self.loan_id = loan_id
-        self.status = status
+    def __init__(self, loan: Loan, log_type: LoanLogType):
+        self.loan = loan
+        self.status = loan.status
         self.timestamp = datetime.now()
+        self.lender_id = loan.lender_id
+        self.borrower_id = loan.borrower_id
 
-        loan = Loan.query.filter_by(id=loan_id).first()
-        lender = User.query.filter_by(id=loan.lender_id).first()
-        borrower = User.query.filter_by(id=loan.borrower_id).first()
+        lender, borrower = loan.lender, loan.borrower
         if log_type in [LoanLogType.REQUEST, LoanLogType.REQUEST_ACCEPTED, LoanLogType.REQUEST_REJECTED]:
             self.message = log_type.value.format(req_full_name=borrower.first_name + " " + borrower.last_name,
                                                  req_username=borrower.username,
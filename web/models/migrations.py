@@ -0,0 +1,133 @@
+from datetime import datetime, date
+
+from sqlalchemy import delete, inspect, insert, select, text
+
+from web.models.db_init import db
+from web.models.search import UserSearchTerm, search_rows
+from web.models.user_models import User
+
+
+class SchemaMigration(db.Model):
+    __tablename__ = 'schema_migrations'
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String(), nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False)
+
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def decorator(function):
+        MIGRATIONS.append((version, description, function))
+        MIGRATIONS.sort(key=lambda entry: entry[0])
+        return function
+    return decorator
+
+
+def column_names(connection, table):
+    return {column["name"] for column in inspect(connection).get_columns(table)}
+
+
+def create_index(connection, name, table, *columns):
+    # indexes are also declared on the models, so fresh databases get them from create_all
+    connection.execute(text("CREATE INDEX IF NOT EXISTS {} ON {} ({})".format(name, table, ", ".join(columns))))
+
+
+# none of these migrations has been released, so none of them handles a schema that existed only while they were
+# written: tables that create_all makes are in their released form, columns of existing tables are added by the
+# migration that needs them; the SQL is spelled out here, later changes to the models do not change a migration
+
+
+@migration(1, "add login_logs.token")
+def add_login_token(connection):
+    if "token" not in column_names(connection, "login_logs"):
+        connection.execute(text("ALTER TABLE login_logs ADD COLUMN token VARCHAR NOT NULL DEFAULT ''"))
+
+
+@migration(2, "add hot-path indexes")
+def add_hot_path_indexes(connection):
+    create_index(connection, "ix_loans_lender_status", "loans", "lender_id", "status")
+    create_index(connection, "ix_loans_borrower_status", "loans", "borrower_id", "status")
+    create_index(connection, "ix_login_logs_user_timestamp", "login_logs", "user_id", "timestamp")
+    create_index(connection, "ix_login_monitor_user", "login_monitor", "user_id")
+    create_index(connection, "ix_loan_logs_loan", "loan_logs", "loan_id")
+
+
+@migration(3, "fill user_balances and pair_balances")
+def fill_balances(connection):
+    # outstanding loans are NOT_PAYED (2) and PENDING (3), migration 5 counts the overdue ones
+    connection.execute(text("DELETE FROM pair_balances"))
+    connection.execute(text("DELETE FROM user_balances"))
+    connection.execute(text("INSERT INTO pair_balances (lender_id, borrower_id, amount) "
+                            "SELECT lender_id, borrower_id, SUM(amount) FROM loans WHERE status IN (2, 3) "
+                            "GROUP BY lender_id, borrower_id"))
+    connection.execute(text("INSERT INTO user_balances (user_id, debt, credit, overdue_count) SELECT id, "
+                            "COALESCE((SELECT SUM(amount) FROM pair_balances WHERE borrower_id = users.id), 0), "
+                            "COALESCE((SELECT SUM(amount) FROM pair_balances WHERE lender_id = users.id), 0), 0 "
+                            "FROM users"))
+
+
+@migration(4, "add keyset pagination columns and indexes")
+def add_pagination_indexes(connection):
+    if "timestamp" not in column_names(connection, "loans"):
+        connection.execute(text("ALTER TABLE loans ADD COLUMN timestamp DATETIME"))
+        connection.execute(text("UPDATE loans SET timestamp = COALESCE("
+                                "(SELECT MIN(timestamp) FROM loan_logs WHERE loan_logs.loan_id = loans.id), "
+                                "CURRENT_TIMESTAMP)"))
+    if "lender_id" not in column_names(connection, "loan_logs"):
+        connection.execute(text("ALTER TABLE loan_logs ADD COLUMN lender_id INTEGER REFERENCES users (id)"))
+        connection.execute(text("ALTER TABLE loan_logs ADD COLUMN borrower_id INTEGER REFERENCES users (id)"))
+        connection.execute(text("UPDATE loan_logs SET "
+                                "lender_id = (SELECT lender_id FROM loans WHERE loans.id = loan_logs.loan_id), "
+                                "borrower_id = (SELECT borrower_id FROM loans WHERE loans.id = loan_logs.loan_id)"))
+    create_index(connection, "ix_loans_lender_timestamp", "loans", "lender_id", "timestamp", "id")
+    create_index(connection, "ix_loans_borrower_timestamp", "loans", "borrower_id", "timestamp", "id")
+    create_index(connection, "ix_loan_logs_lender_timestamp", "loan_logs", "lender_id", "timestamp", "id")
+    create_index(connection, "ix_loan_logs_borrower_timestamp", "loan_logs", "borrower_id", "timestamp", "id")
+    create_index(connection, "ix_messages_receiver_resolved_timestamp",
+                 "messages", "receiver_id", "resolved", "timestamp", "id")
+    create_index(connection, "ix_notifications_receiver_timestamp", "notifications", "receiver_id", "timestamp", "id")
+
+
+@migration(5, "precompute overdue loans")
+def add_overdue_flags(connection):
+    if "overdue" not in column_names(connection, "loans"):
+        connection.execute(text("ALTER TABLE loans ADD COLUMN overdue BOOLEAN NOT NULL DEFAULT FALSE"))
+        # already late loans are marked without notifications, only new ones are announced by the scan
+        connection.execute(text("UPDATE loans SET overdue = TRUE WHERE status IN (2, 3) AND deadline < :today"),
+                           {"today": date.today()})
+    create_index(connection, "ix_loans_status_overdue_deadline", "loans", "status", "overdue", "deadline")
+    connection.execute(text("UPDATE user_balances SET overdue_count = (SELECT COUNT(*) FROM loans "
+                            "WHERE borrower_id = user_balances.user_id AND status IN (2, 3) AND overdue)"))
+
+
+@migration(6, "index user names for prefix search")
+def add_user_search_terms(connection):
+    UserSearchTerm.__table__.create(connection, checkfirst=True)
+    create_index(connection, "ix_user_search_terms_user", "user_search_terms", "user_id", "term")
+    # new users are indexed when they register, the ones registered before are indexed here
+    connection.execute(delete(UserSearchTerm))
+    rows = search_rows(connection.execute(select(User.id, User.username, User.first_name, User.last_name)))
+    if rows:
+        connection.execute(insert(UserSearchTerm), rows)
+
+
+def applied_versions():
+    return {row.version for row in SchemaMigration.query.all()}
+
+
+def apply_migrations():
+    applied = applied_versions()
+    done = []
+    for version, description, function in MIGRATIONS:
+        if version in applied:
+            continue
+        # every migration is idempotent, so workers starting at the same time can race safely
+        with db.engine.begin() as connection:
+            function(connection)
+        if db.session.get(SchemaMigration, version) is None:
+            db.session.add(SchemaMigration(version=version, description=description, applied_at=datetime.now()))
+            db.session.commit()
+        done.append((version, description))
+    return done
@@ -1,41 +1,69 @@
-from sqlalchemy import func, or_
+import os
+from collections import Counter
+from datetime import date
 
+from sqlalchemy import delete, exists, func, insert, literal, select, update
+
+from web.models.balance_models import UserBalance, PairBalance, LedgerGeneration, GLOBAL_GENERATION, increment, \
+    bump_generations
 from web.models.db_init import db
-from web.models.user_models import User, LoginLog
-from web.models.loan_models import Loan, LoanStatus, LoanLog
+from web.jobs import job, schedule
+from web.rate_limiter import failed_logins
+from web.models.user_models import User, LoginLog, LoginMonitor
+from web.models.loan_models import Loan, LoanStatus, LoanLog, LoanMessage, OUTSTANDING_STATUSES
 from web.models.notification_model import Notification, NotificationType
+from web.models.pagination import keyset_page, merge_pages
+
+OVERDUE_SCAN_SECONDS = float(os.environ.get("OVERDUE_SCAN_SECONDS", "3600"))
+OVERDUE_NOTIFICATIONS = os.environ.get("OVERDUE_NOTIFICATIONS", "True") == "True"
 
 
 def loans_given(user: User):
     query = (
-        db.session.query(User.username, func.sum(Loan.amount).label('total_amount'))
-        .join(Loan, User.id == Loan.borrower_id)
-        .filter(Loan.lender_id == user.id, Loan.status.in_([LoanStatus.NOT_PAYED.value, LoanStatus.PENDING.value]))
-        .group_by(User.username)
+        db.session.query(User.username, PairBalance.amount.label('total_amount'))
+        .join(PairBalance, User.id == PairBalance.borrower_id)
+        .filter(PairBalance.lender_id == user.id)
     )
     return query.all()
 
 
 def loans_taken(user: User):
     query = (
-        db.session.query(User.username, func.sum(Loan.amount).label('total_amount'))
-        .join(Loan, User.id == Loan.lender_id)
-        .filter(Loan.borrower_id == user.id,
-                Loan.status.in_([LoanStatus.NOT_PAYED.value, LoanStatus.PENDING.value]))
-        .group_by(User.username)
+        db.session.query(User.username, PairBalance.amount.label('total_amount'))
+        .join(PairBalance, User.id == PairBalance.lender_id)
+        .filter(PairBalance.borrower_id == user.id)
     )
     return query.all()
 
 
-def search_users():
-    user_loan_info = db.session.query(
-        User.username,
-        User.first_name,
-        User.last_name,
-        func.sum(Loan.amount).label('total_debt')
-    ).join(Loan, User.id == Loan.borrower_id).group_by(User.id).all()
-
-    return user_loan_info
+def rebuild_balances(connection):
+    outstanding = Loan.status.in_(OUTSTANDING_STATUSES)
+    connection.execute(delete(PairBalance))
+    connection.execute(delete(UserBalance))
+    connection.execute(insert(PairBalance).from_select(
+        ["lender_id", "borrower_id", "amount"],
+        select(Loan.lender_id, Loan.borrower_id, func.sum(Loan.amount))
+        .where(outstanding).group_by(Loan.lender_id, Loan.borrower_id)
+    ))
+    connection.execute(insert(UserBalance).from_select(
+        ["user_id", "debt", "credit"], select(User.id, 0, 0)
+    ))
+    connection.execute(update(UserBalance).values(
+        debt=func.coalesce(select(func.sum(PairBalance.amount))
+                           .where(PairBalance.borrower_id == UserBalance.user_id).scalar_subquery(), 0),
+        credit=func.coalesce(select(func.sum(PairBalance.amount))
+                             .where(PairBalance.lender_id == UserBalance.user_id).scalar_subquery(), 0),
+        overdue_count=select(func.count(Loan.id))
+        .where(Loan.borrower_id == UserBalance.user_id, outstanding, Loan.overdue.is_(True)).scalar_subquery()
+    ))
+    # every cached fragment is rendered again, including those of users who never had a generation row
+    connection.execute(update(LedgerGeneration).values(generation=LedgerGeneration.generation + 1))
+    connection.execute(insert(LedgerGeneration).from_select(
+        ["scope", "generation"],
+        select(User.id, 1).where(User.id.not_in(select(LedgerGeneration.scope)))
+        .union_all(select(literal(GLOBAL_GENERATION), literal(1))
+                   .where(~exists().where(LedgerGeneration.scope == GLOBAL_GENERATION)))
+    ))
 
 
 def reverse_loan_status(status):
@@ -51,42 +79,79 @@ def reverse_loan_status(status):
         return "CANCELED"
 
 
-def get_all_loans(user: User):
-    loans = Loan.query.filter(
-        Loan.lender_id == user.id,
-        Loan.status.in_([LoanStatus.NOT_PAYED.value, LoanStatus.PENDING.value, LoanStatus.PAYED.value])
-    ).all()
+def get_all_loans(user: User, cursor=None):
+    page = keyset_page(
+        Loan.query.filter(
+            Loan.lender_id == user.id,
+            Loan.status.in_([LoanStatus.NOT_PAYED.value, LoanStatus.PENDING.value, LoanStatus.PAYED.value])
+        ),
+        Loan.timestamp, Loan.id, cursor
+    )
 
-    for loan in loans:
+    for loan in page.items:
         loan.status = reverse_loan_status(loan.status)
 
-    return loans
+    return page
 
 
-def get_all_debts(user: User):
-    debts = Loan.query.filter(
-        Loan.borrower_id == user.id,
-        Loan.status.in_([LoanStatus.NOT_PAYED.value, LoanStatus.PENDING.value, LoanStatus.PAYED.value])
-    ).all()
+def get_all_debts(user: User, cursor=None):
+    page = keyset_page(
+        Loan.query.filter(
+            Loan.borrower_id == user.id,
+            Loan.status.in_([LoanStatus.NOT_PAYED.value, LoanStatus.PENDING.value, LoanStatus.PAYED.value])
+        ),
+        Loan.timestamp, Loan.id, cursor
+    )
 
-    for debt in debts:
+    for debt in page.items:
         debt.status = reverse_loan_status(debt.status)
 
-    return debts
+    return page
 
 
-def get_logs(user: User):
-    logs = (
-        db.session.query(LoanLog)
-        .join(Loan, Loan.id == LoanLog.loan_id)
-        .filter(or_(Loan.borrower_id == user.id, Loan.lender_id == user.id))
-        .all()
-    )
+def get_logs(user: User, cursor=None):
+    # one indexed range per side of the loan instead of an OR that has to be sorted as a whole
+    page = merge_pages([
+        keyset_page(LoanLog.query.filter(LoanLog.lender_id == user.id), LoanLog.timestamp, LoanLog.id, cursor),
+        keyset_page(LoanLog.query.filter(LoanLog.borrower_id == user.id), LoanLog.timestamp, LoanLog.id, cursor),
+    ])
 
-    for log in logs:
+    for log in page.items:
         log.status = reverse_loan_status(log.status)
 
-    return logs
+    return page
+
+
+def get_messages(user: User, cursor=None):
+    return keyset_page(LoanMessage.query.filter_by(receiver_id=user.id, resolved=False),
+                       LoanMessage.timestamp, LoanMessage.id, cursor)
+
+
+# statements shared with the async session of the ASGI app (web/models/async_db.py)
+def unresolved_messages_count(user: User):
+    return select(func.count(LoanMessage.id)).where(LoanMessage.receiver_id == user.id,
+                                                    LoanMessage.resolved.is_(False))
+
+
+def inbox_rows(user: User, model, ids):
+    # rows announced by the inbox stream, newest first like the pages they are prepended to
+    statement = select(model).where(model.id.in_(ids), model.receiver_id == user.id)
+    if model is LoanMessage:
+        statement = statement.where(LoanMessage.resolved.is_(False))
+    return statement.order_by(model.timestamp.desc(), model.id.desc())
+
+
+def count_unresolved_messages(user: User):
+    return db.session.scalar(unresolved_messages_count(user))
+
+
+def get_inbox_rows(user: User, model, ids):
+    return db.session.scalars(inbox_rows(user, model, ids)).all()
+
+
+def get_notifications(user: User, cursor=None):
+    return keyset_page(Notification.query.filter_by(receiver_id=user.id),
+                       Notification.timestamp, Notification.id, cursor)
 
 
 def compare_logins(previous_login: LoginLog, current_login: LoginLog, user: User):
@@ -101,7 +166,7 @@ def compare_logins(previous_login: LoginLog, current_login: LoginLog, user: User
             previous_login.is_pc != current_login.is_pc or \
             previous_login.is_bot != current_login.is_bot:
         notification = Notification(user.id, NotificationType.LOGIN_FROM_NEW_DEVICE, login_log=previous_login)
-        notification.add_to_db()
+        db.session.add(notification)
         return
 
     if previous_login.browser_family != current_login.browser_family or \
@@ -109,7 +174,68 @@ def compare_logins(previous_login: LoginLog, current_login: LoginLog, user: User
             previous_login.os_family != current_login.os_family or \
             previous_login.os_version != current_login.os_version:
         notification = Notification(user.id, NotificationType.LOGIN_FROM_NEW_BROWSER, login_log=previous_login)
-        notification.add_to_db()
+        db.session.add(notification)
     return
 
 
+@job("login_followup")
+def login_followup(user_id, login_log_id):
+    # runs on the job queue after a successful login, its notifications and the monitor reset share one commit
+    user = db.session.get(User, user_id)
+    current_login = db.session.get(LoginLog, login_log_id)
+    previous_login = (LoginLog.query.filter(LoginLog.user_id == user_id, LoginLog.id < login_log_id)
+                      .order_by(LoginLog.timestamp.desc(), LoginLog.id.desc()).first())
+    compare_logins(previous_login, current_login, user)
+
+    # failures not flushed into the monitor yet
+    failures = failed_logins.count(user_id)
+    login_monitor = LoginMonitor.query.filter_by(user_id=user_id).first()
+    login_monitor.login_count += failures
+    if login_monitor.login_count >= 3:
+        db.session.add(Notification(user_id, NotificationType.FAILED_LOGINS, login_monitor=login_monitor))
+    login_monitor.reset()
+    # after the commit, a retried job reads the same failures again
+    failed_logins.settle(user_id, failures)
+
+
+@job("flush_failed_logins")
+def flush_failed_logins(user_ids):
+    # the failed logins a worker counted in the shared map, added to login_monitor in one commit
+    counts = {user_id: failed_logins.count(user_id) for user_id in user_ids}
+    counts = {user_id: count for user_id, count in counts.items() if count}
+    if not counts:
+        return
+    for login_monitor in LoginMonitor.query.filter(LoginMonitor.user_id.in_(counts)):
+        login_monitor.add_failures(counts[login_monitor.user_id])
+    db.session.commit()
+    for user_id, count in counts.items():
+        failed_logins.settle(user_id, count)
+
+
+def mark_overdue_loans(today=None, notify=OVERDUE_NOTIFICATIONS):
+    # one range on ix_loans_status_overdue_deadline: outstanding loans, not marked yet, deadline already passed
+    today = today or date.today()
+    candidates = Loan.query.filter(Loan.status.in_(OUTSTANDING_STATUSES), Loan.overdue.is_(False),
+                                   Loan.deadline < today).all()
+    # each loan is marked only if it is still unmarked, so a concurrent scan never counts it twice;
+    # UPDATE ... RETURNING would do this in one statement, but it needs SQLite 3.35
+    marked = [loan for loan in candidates
+              if db.session.execute(update(Loan).where(Loan.id == loan.id, Loan.overdue.is_(False))
+                                    .values(overdue=True), execution_options={"synchronize_session": False}).rowcount]
+    for borrower_id, count in Counter(loan.borrower_id for loan in marked).items():
+        increment(UserBalance, {"user_id": borrower_id}, {"overdue_count": count})
+    if marked:
+        bump_generations({user_id for loan in marked for user_id in (loan.lender_id, loan.borrower_id)})
+    if notify:
+        for loan in marked:
+            db.session.add(Notification(loan.borrower_id, NotificationType.LOAN_OVERDUE, loan=loan))
+    db.session.commit()
+    return len(marked)
+
+
+@job("scan_overdue_loans")
+def scan_overdue_loans():
+    mark_overdue_loans()
+
+
+schedule("scan_overdue_loans", OVERDUE_SCAN_SECONDS)
@@ -0,0 +1,80 @@
+import heapq
+import threading
+from collections import namedtuple
+
+from sqlalchemy import func
+
+from web.metrics import timed
+from web.models.balance_models import UserBalance, PairBalance, SETTLED_EPSILON, GLOBAL_GENERATION, ledger_generation
+from web.models.db_init import db
+from web.models.user_models import User
+
+Position = namedtuple("Position", "user_id username first_name last_name net")
+Transfer = namedtuple("Transfer", "payer payee amount")
+# pairs: outstanding (lender, borrower) debts the transfers replace
+Plan = namedtuple("Plan", "generation positions transfers pairs")
+
+
+def net_positions():
+    # credit and debt of every user are kept up to date by each loan transition (apply_balance_changes),
+    # so the positions cost one row per user and never a scan of the loans
+    net = (UserBalance.credit - UserBalance.debt).label("net")
+    rows = (
+        db.session.query(User.id, User.username, User.first_name, User.last_name, net)
+        .join(UserBalance, User.id == UserBalance.user_id)
+        .filter(func.abs(net) >= SETTLED_EPSILON)
+        .order_by(User.id)
+    )
+    return [Position(*row) for row in rows]
+
+
+def settle(positions):
+    # greedy min cash flow: the largest debtor pays the largest creditor until one of the two is settled;
+    # every transfer settles at least one user, so there are at most len(positions) - 1 of them, in O(V log V).
+    # The fewest transfers possible is NP-hard to find, this bound is what the plan guarantees
+    creditors = [(-position.net, i, position) for i, position in enumerate(positions) if position.net > 0]
+    debtors = [(position.net, i, position) for i, position in enumerate(positions) if position.net < 0]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+    transfers = []
+    while creditors and debtors:
+        credit, i, creditor = heapq.heappop(creditors)
+        debt, j, debtor = heapq.heappop(debtors)
+        amount = min(-credit, -debt)
+        transfers.append(Transfer(debtor, creditor, amount))
+        if -credit - amount >= SETTLED_EPSILON:
+            heapq.heappush(creditors, (credit + amount, i, creditor))
+        if -debt - amount >= SETTLED_EPSILON:
+            heapq.heappush(debtors, (debt + amount, j, debtor))
+    return transfers
+
+
+class PlanCache:
+    # the plan of the newest global generation this worker computed; any loan transition bumps the generation,
+    # and the first request after it rebuilds the whole plan: O(V) rows of user_balances and O(V log V) on the
+    # heaps. The heaps are not patched per changed pair, one changed position can reorder every later pairing
+    # of the greedy plan, and the loans themselves are never scanned
+    def __init__(self):
+        self.plan = None
+        self.lock = threading.Lock()
+
+    def get(self, generation):
+        plan = self.plan
+        if plan is not None and plan.generation == generation:
+            return plan
+        # the generation was read first, these positions are at least as new as it
+        with timed("settlement_plan_seconds"):
+            positions = net_positions()
+            pairs = db.session.query(func.count()).select_from(PairBalance).scalar()
+            plan = Plan(generation, positions, settle(positions), pairs)
+        with self.lock:
+            if self.plan is None or self.plan.generation <= generation:
+                self.plan = plan
+        return plan
+
+
+plans = PlanCache()
+
+
+def settlement_plan():
+    return plans.get(ledger_generation(GLOBAL_GENERATION))
@@ -8,17 +8,21 @@ class NotificationType(Enum):
     FAILED_LOGINS = "Someone tried to log in to your account {tries} times unsuccessfully."
     LOGIN_FROM_NEW_DEVICE = "Is that you? Someone logged in to your account from a new device. Previous index was from {device_brand} {device_model} ({os_family} {os_version})."
     LOGIN_FROM_NEW_BROWSER = "Is that you? Someone logged in to your account from a new browser. Previous index was from {browser_family} {browser_version} on {os_family} {os_version}."
+    LOAN_OVERDUE = "Your debt of {amount} to {lender} was due on {deadline}."
 
 
 class Notification(db.Model):
     __tablename__ = 'notifications'
+    __table_args__ = (
+        db.Index('ix_notifications_receiver_timestamp', 'receiver_id', 'timestamp', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     receiver_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     message = db.Column(db.String(), nullable=False)
     # seen = db.Column(db.Boolean, nullable=False, default=False)
     timestamp = db.Column(db.DateTime, nullable=False)
 
-    def __init__(self, receiver_id, notification_type: NotificationType, login_log=None, login_monitor=None):
+    def __init__(self, receiver_id, notification_type: NotificationType, login_log=None, login_monitor=None, loan=None):
         self.receiver_id = receiver_id
         self.timestamp = datetime.now()
 
@@ -34,6 +38,10 @@ class Notification(db.Model):
                                                           browser_version=login_log.browser_version,
                                                           os_family=login_log.os_family,
                                                           os_version=login_log.os_version)
+        elif notification_type == NotificationType.LOAN_OVERDUE:
+            self.message = notification_type.value.format(amount=loan.amount,
+                                                          lender=loan.lender.username,
+                                                          deadline=loan.deadline)
 
     def add_to_db(self):
         db.session.add(self)
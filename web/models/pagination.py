@@ -0,0 +1,56 @@
+import base64
+import binascii
+from datetime import datetime
+from heapq import merge
+
+from sqlalchemy import tuple_
+
+
+PAGE_SIZE = 25
+
+
+class Page:
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+
+def encode_cursor(timestamp, id):
+    return base64.urlsafe_b64encode("{}|{}".format(timestamp.isoformat(), id).encode("utf8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        timestamp, id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf8").split("|")
+        return datetime.fromisoformat(timestamp), int(id)
+    except (ValueError, UnicodeError, binascii.Error):
+        return None
+
+
+def keyset_page(query, timestamp_column, id_column, cursor, size=PAGE_SIZE):
+    # newest first; the cursor is the (timestamp, id) of the last row already shown
+    position = decode_cursor(cursor)
+    if position is not None:
+        query = query.filter(tuple_(timestamp_column, id_column) < tuple_(*position))
+    rows = query.order_by(timestamp_column.desc(), id_column.desc()).limit(size + 1).all()
+    return _page(rows, size)
+
+
+def merge_pages(pages, size=PAGE_SIZE):
+    # pages of disjoint row sets fetched with the same cursor, each already ordered newest first
+    rows = []
+    for row in merge(*(page.items for page in pages), key=lambda row: (row.timestamp, row.id), reverse=True):
+        if not rows or rows[-1].id != row.id:
+            rows.append(row)
+    if len(rows) <= size and all(page.next_cursor is None for page in pages):
+        return Page(rows, None)
+    return Page(rows[:size], encode_cursor(rows[size - 1].timestamp, rows[size - 1].id))
+
+
+def _page(rows, size):
+    if len(rows) <= size:
+        return Page(rows, None)
+    rows = rows[:size]
+    return Page(rows, encode_cursor(rows[-1].timestamp, rows[-1].id))
@@ -0,0 +1,68 @@
+from types import SimpleNamespace
+
+from sqlalchemy import event
+
+from web.models.db_init import db
+from web.models.model_handler import loans_given, loans_taken, get_all_loans, get_all_debts, get_logs, \
+    get_messages, get_notifications, count_unresolved_messages
+from web.models.search import search_users
+from web.models.user_models import LoginLog, LoginMonitor
+
+
+def _last_login(user):
+    LoginLog.query.filter_by(user_id=user.id).order_by(LoginLog.timestamp.desc()).first()
+
+
+def _login_monitor(user):
+    LoginMonitor.query.filter_by(user_id=user.id).first()
+
+
+# (name, query function, whether a full table scan is expected)
+CHECKED_QUERIES = [
+    ("loans_given", loans_given, False),
+    ("loans_taken", loans_taken, False),
+    ("get_all_loans", get_all_loans, False),
+    ("get_all_debts", get_all_debts, False),
+    ("get_logs", get_logs, False),
+    ("search_debtors", lambda user: search_users("", debtors=True), False),
+    ("search_users", lambda user: search_users("ala k", cursor="YWxhIGtvdHwx"), False),
+    ("last_login", _last_login, False),
+    ("login_monitor", _login_monitor, False),
+    ("get_messages", get_messages, False),
+    ("get_notifications", get_notifications, False),
+    ("count_unresolved_messages", count_unresolved_messages, False),
+]
+
+
+def capture_statements(function, *args):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        function(*args)
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+        db.session.rollback()
+    return statements
+
+
+def full_scans(plan):
+    return [detail for detail in plan if detail.startswith("SCAN ") and " USING " not in detail]
+
+
+def check_query_plans():
+    if db.engine.dialect.name != "sqlite":
+        raise RuntimeError("Query plan checks are only implemented for SQLite")
+    user = SimpleNamespace(id=0)
+    results = []
+    for name, function, scan_expected in CHECKED_QUERIES:
+        for statement, parameters in capture_statements(function, user):
+            with db.engine.connect() as connection:
+                rows = connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters).all()
+            plan = [row[-1] for row in rows]
+            ok = scan_expected or not full_scans(plan)
+            results.append((name, ok, plan))
+    return results
@@ -0,0 +1,91 @@
+import base64
+import binascii
+import os
+
+from sqlalchemy import event, exists, insert, tuple_
+from sqlalchemy.orm import aliased
+
+from web.models.balance_models import UserBalance, SETTLED_EPSILON
+from web.models.db_init import db
+from web.models.pagination import Page
+from web.models.user_models import User
+
+SEARCH_PAGE_SIZE = int(os.environ.get("SEARCH_PAGE_SIZE", "10"))
+MAX_PREFIX = 40
+# validate_name and validate_last_name allow these letters, a search without them matches names with them
+POLISH_LETTERS = str.maketrans("ąćęłńóśźżĄĆĘŁŃÓŚŹŻ", "acelnoszzACELNOSZZ")
+
+
+def fold(text):
+    return " ".join(text.translate(POLISH_LETTERS).lower().split())
+
+
+class UserSearchTerm(db.Model):
+    __tablename__ = 'user_search_terms'
+    __table_args__ = (
+        db.Index('ix_user_search_terms_user', 'user_id', 'term'),
+    )
+    # folded username and names, a prefix search is a range scan of the primary key; the scan and the
+    # (term, user_id) cursor need codepoint order, SQLite's default BINARY, on PostgreSQL "C" instead of the locale
+    term = db.Column(db.String().with_variant(db.String(collation="C"), "postgresql"), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True, autoincrement=False)
+
+
+def search_terms(user):
+    first_name, last_name = fold(user.first_name), fold(user.last_name)
+    terms = {fold(user.username), first_name + " " + last_name}
+    # "kowalska" and "nowak" both find Ala Nowak-Kowalska
+    terms.update(part + " " + first_name for part in [last_name] + last_name.split("-"))
+    return terms
+
+
+def search_rows(users):
+    return [{"term": term, "user_id": user.id} for user in users for term in search_terms(user)]
+
+
+@event.listens_for(User, "after_insert")
+def index_new_user(mapper, connection, user):
+    # in the transaction of the registration, names do not change afterwards
+    connection.execute(insert(UserSearchTerm), search_rows([user]))
+
+
+def encode_cursor(term, user_id):
+    return base64.urlsafe_b64encode("{}|{}".format(term, user_id).encode("utf8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        term, user_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf8").rsplit("|", 1)
+        return term, int(user_id)
+    except (ValueError, UnicodeError, binascii.Error):
+        return None
+
+
+def search_users(prefix, cursor=None, debtors=False, size=SEARCH_PAGE_SIZE):
+    # users with a term starting with the prefix, in term order; a page reads at most size + 1 index entries
+    # (more with debtors=True, users without debt are skipped), however many users there are
+    prefix = fold(prefix)[:MAX_PREFIX]
+    upper = prefix + "\uffff"
+    earlier = aliased(UserSearchTerm)
+    query = (
+        db.session.query(UserSearchTerm.term, User.id, User.username, User.first_name, User.last_name,
+                         UserBalance.debt.label('total_debt'), (UserBalance.overdue_count > 0).label('overdue'))
+        .join(User, User.id == UserSearchTerm.user_id)
+        .outerjoin(UserBalance, UserBalance.user_id == User.id)
+        .filter(UserSearchTerm.term >= prefix, UserSearchTerm.term < upper)
+        # a user matching several terms is listed once, at the first of them
+        .filter(~exists().where(earlier.user_id == UserSearchTerm.user_id, earlier.term >= prefix,
+                                earlier.term < UserSearchTerm.term))
+    )
+    if debtors:
+        query = query.filter(UserBalance.debt >= SETTLED_EPSILON)
+    position = decode_cursor(cursor)
+    if position is not None:
+        query = query.filter(tuple_(UserSearchTerm.term, UserSearchTerm.user_id) > tuple_(*position))
+    rows = query.order_by(UserSearchTerm.term, UserSearchTerm.user_id).limit(size + 1).all()
+    if len(rows) <= size:
+        return Page(rows, None)
+    rows = rows[:size]
+    return Page(rows, encode_cursor(rows[-1].term, rows[-1].id))
@@ -4,8 +4,13 @@ from string import ascii_letters, digits
 
 from flask_login import UserMixin
 from flask_wtf.csrf import generate_csrf
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+from web.models import identity_cache
 from web.models.db_init import db
-from web.security_utils import hash_password
+from web.security_utils import hash_password, verify_password, password_needs_rehash
+from web.user_agent_cache import UserAgentInfo
 
 
 class User(UserMixin, db.Model):
@@ -29,6 +34,24 @@ class User(UserMixin, db.Model):
     def get_id(self):
         return str(self.username)
 
+    @classmethod
+    def load(cls, username):
+        snapshot = identity_cache.users.get(username)
+        if snapshot is None:
+            user = cls.query.filter_by(username=username).first()
+            if user:
+                identity_cache.users.set(username, user.snapshot())
+            return user
+        # rebuild the row without a query and attach it to this request's session
+        user = inspect(cls).class_manager.new_instance()
+        for key, value in snapshot.items():
+            setattr(user, key, value)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    def snapshot(self):
+        return {attr.key: getattr(self, attr.key) for attr in inspect(type(self)).column_attrs}
+
     def add_to_db(self):
         db.session.add(self)
         db.session.commit()
@@ -38,14 +61,30 @@ class User(UserMixin, db.Model):
     def last_login(self):
         return LoginLog.query.filter_by(user_id=self.id).order_by(LoginLog.timestamp.desc()).first()
 
+    def check_password(self, password):
+        if not verify_password(password, self.salt, self.password):
+            return False
+        if password_needs_rehash(self.password):
+            self.change_password(password)
+        return True
+
+    def change_password(self, new_password):
+        self.password = hash_password(new_password, self.salt)
+        db.session.commit()
+        identity_cache.users.invalidate(self.username)
+
     def recover(self, new_password):
         self.password = hash_password(new_password, self.salt)
         self.recovery_password = "".join([secrets.choice(ascii_letters + digits) for _ in range(16)])
         db.session.commit()
+        identity_cache.users.invalidate(self.username)
 
 
 class LoginLog(db.Model):
     __tablename__ = 'login_logs'
+    __table_args__ = (
+        db.Index('ix_login_logs_user_timestamp', 'user_id', 'timestamp'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     timestamp = db.Column(db.DateTime, nullable=False)
@@ -62,16 +101,16 @@ class LoginLog(db.Model):
     is_bot = db.Column(db.Boolean, nullable=False)
     token = db.Column(db.String(), nullable=False)
 
-    def __init__(self, user_id, user_info):
+    def __init__(self, user_id, user_info: UserAgentInfo):
         self.user_id = user_id
         self.timestamp = datetime.now()
-        self.browser_family = user_info.browser.family
-        self.browser_version = user_info.browser.version_string
-        self.os_family = user_info.os.family
-        self.os_version = user_info.os.version_string
-        self.device_family = user_info.device.family if user_info.device.family else "N/A"
-        self.device_brand = user_info.device.brand if user_info.device.brand else "N/A"
-        self.device_model = user_info.device.model if user_info.device.model else "N/A"
+        self.browser_family = user_info.browser_family
+        self.browser_version = user_info.browser_version
+        self.os_family = user_info.os_family
+        self.os_version = user_info.os_version
+        self.device_family = user_info.device_family
+        self.device_brand = user_info.device_brand
+        self.device_model = user_info.device_model
         self.is_mobile = user_info.is_mobile
         self.is_tablet = user_info.is_tablet
         self.is_pc = user_info.is_pc
@@ -81,10 +120,14 @@ class LoginLog(db.Model):
     def add_to_db(self):
         db.session.add(self)
         db.session.commit()
+        identity_cache.remember_token(self.user_id, self.token)
 
 
 class LoginMonitor(db.Model):
     __tablename__ = 'login_monitor'
+    __table_args__ = (
+        db.Index('ix_login_monitor_user', 'user_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     last_login = db.Column(db.Date, nullable=False)
@@ -99,10 +142,9 @@ class LoginMonitor(db.Model):
         db.session.add(self)
         db.session.commit()
 
-    def update(self):
+    def add_failures(self, count):
         self.last_login = date.today()
-        self.login_count += 1
-        db.session.commit()
+        self.login_count += count
 
     def reset(self):
         self.last_login = date.today()
@@ -0,0 +1,209 @@
+import math
+import re
+from collections import namedtuple
+from string import ascii_lowercase, ascii_uppercase, digits
+
+from web.dictionary_index import DEFAULT_DICTIONARY
+
+MAX_PASSWORD_LENGTH = 64
+MIN_WORD_LENGTH = 3
+MIN_RUN_LENGTH = 3
+SPECIAL_CHARS = "!@#$%^&*()-_+=~`[]{}|:;\"'<>,.?/"
+
+Match = namedtuple("Match", ["pattern", "start", "end", "token", "guesses"])
+
+# everything below is built once at import, an estimate only does dictionary and table lookups
+
+
+def _ranked_words(path):
+    ranks = {}
+    with open(path, "r", encoding="utf8", errors="ignore") as f:
+        for rank, line in enumerate(f, start=1):
+            word = line.strip().lower()
+            if len(word) >= MIN_WORD_LENGTH and word not in ranks:
+                ranks[word] = rank
+    return ranks
+
+
+RANKED_WORDS = _ranked_words(DEFAULT_DICTIONARY)
+REVERSED_WORDS = {word[::-1]: rank for word, rank in RANKED_WORDS.items() if word[::-1] not in RANKED_WORDS}
+MAX_WORD_LENGTH = max(map(len, RANKED_WORDS), default=0)
+# lets the scan stop extending a substring as soon as no word starts with it
+WORD_PREFIXES = frozenset(word[:length] for word in (*RANKED_WORDS, *REVERSED_WORDS)
+                          for length in range(MIN_WORD_LENGTH, len(word) + 1))
+
+# common l33t substitutions, "1" is tried both as "i" and as "l"
+L33T_TABLES = [
+    str.maketrans({"4": "a", "@": "a", "8": "b", "(": "c", "3": "e", "6": "g", "1": "i", "!": "i",
+                   "0": "o", "$": "s", "5": "s", "7": "t", "+": "t", "2": "z"}),
+    str.maketrans({"1": "l", "|": "l"}),
+]
+
+KEYBOARD_ROWS = [
+    ("`1234567890-=", "~!@#$%^&*()_+"),
+    ("qwertyuiop[]\\", "QWERTYUIOP{}|"),
+    ("asdfghjkl;'", "ASDFGHJKL:\""),
+    ("zxcvbnm,./", "ZXCVBNM<>?"),
+]
+# rows are shifted by half a key, so each key touches two keys in the row above and two below
+KEYBOARD_DIRECTIONS = [(0, -1), (0, 1), (-1, 0), (-1, 1), (1, -1), (1, 0)]
+
+
+def _keyboard_graph(rows):
+    positions, shifted = {}, set()
+    for row, (plain, shift) in enumerate(rows):
+        for column, (key, shift_key) in enumerate(zip(plain, shift)):
+            positions[key] = positions[shift_key] = (row, column)
+            shifted.add(shift_key)
+    by_position = {}
+    for key, position in positions.items():
+        by_position.setdefault(position, set()).add(key)
+    graph = {}
+    for key, (row, column) in positions.items():
+        graph[key] = {}
+        for direction, (row_step, column_step) in enumerate(KEYBOARD_DIRECTIONS):
+            for neighbour in by_position.get((row + row_step, column + column_step), ()):
+                graph[key][neighbour] = direction
+    return graph, shifted
+
+
+KEYBOARD_GRAPH, SHIFTED_KEYS = _keyboard_graph(KEYBOARD_ROWS)
+KEYBOARD_KEYS = sum(len(plain) for plain, _ in KEYBOARD_ROWS)
+KEYBOARD_DEGREE = sum(len(set(neighbours.values())) for neighbours in KEYBOARD_GRAPH.values()) / len(KEYBOARD_GRAPH)
+
+REPEAT_PATTERN = re.compile(r"(.+?)\1+")
+
+STRENGTH_LEVELS = [(25, "poor"), (50, "weak"), (75, "reasonable"), (math.inf, "very good")]
+
+
+def character_pool(password):
+    pool = 0
+    for alphabet in (ascii_lowercase, ascii_uppercase, digits, SPECIAL_CHARS):
+        if any(char in alphabet for char in password):
+            pool += len(alphabet)
+    other = {char for char in password if not char.isascii()}
+    return pool + len(other) or 1
+
+
+def uppercase_variations(token):
+    uppers = sum(char.isupper() for char in token)
+    if uppers == 0:
+        return 1
+    if uppers == len(token) or (uppers == 1 and token[0].isupper()) or (uppers == 1 and token[-1].isupper()):
+        return 2
+    return sum(math.comb(len(token), k) for k in range(1, min(uppers, len(token) - uppers) + 1)) or 2
+
+
+def dictionary_matches(password):
+    # substitutions are per character, so the whole password is translated once and then sliced
+    lowered = password.lower()
+    variants = [(lowered, 1)] + [(lowered.translate(table), None) for table in L33T_TABLES]
+    for text, variations in variants:
+        if variations is None and text == lowered:
+            continue
+        for start in range(len(password)):
+            for end in range(start + MIN_WORD_LENGTH, min(len(password), start + MAX_WORD_LENGTH) + 1):
+                word = text[start:end]
+                if word not in WORD_PREFIXES:
+                    break
+                for ranks, reversed_factor in ((RANKED_WORDS, 1), (REVERSED_WORDS, 2)):
+                    rank = ranks.get(word)
+                    if not rank:
+                        continue
+                    token = password[start:end]
+                    substitutions = variations or 2 ** sum(a != b for a, b in zip(word, lowered[start:end]))
+                    if substitutions == 1 and variations is None:
+                        continue  # no substitution inside this word, already matched as plain text
+                    guesses = rank * reversed_factor * substitutions * uppercase_variations(token)
+                    yield Match("dictionary", start, end, token, guesses)
+
+
+def keyboard_matches(password):
+    start = 0
+    while start < len(password) - 1:
+        end, turns, direction = start + 1, 0, None
+        while end < len(password):
+            step = KEYBOARD_GRAPH.get(password[end - 1], {}).get(password[end])
+            if step is None:
+                break
+            if step != direction:
+                turns, direction = turns + 1, step
+            end += 1
+        if end - start >= MIN_RUN_LENGTH:
+            token = password[start:end]
+            guesses = sum(math.comb(len(token) - 1, turn - 1) * KEYBOARD_KEYS * KEYBOARD_DEGREE ** turn
+                          for turn in range(1, turns + 1))
+            shifted = sum(char in SHIFTED_KEYS for char in token)
+            if shifted:
+                guesses *= 2 if shifted in (1, len(token)) else 2 ** min(shifted, len(token) - shifted)
+            yield Match("keyboard", start, end, token, guesses)
+            start = end - 1
+        else:
+            start += 1
+
+
+def sequence_matches(password):
+    start = 0
+    while start < len(password) - 1:
+        delta = ord(password[start + 1]) - ord(password[start])
+        end = start + 2
+        while end < len(password) and ord(password[end]) - ord(password[end - 1]) == delta:
+            end += 1
+        if end - start >= MIN_RUN_LENGTH and 0 < abs(delta) <= 5:
+            token = password[start:end]
+            first = token[0]
+            if first in "aAzZ019":
+                base = 4
+            elif first.isdigit():
+                base = 10
+            else:
+                base = 26
+            guesses = base * len(token) * (2 if delta < 0 else 1) * abs(delta)
+            yield Match("sequence", start, end, token, guesses)
+        # runs are maximal, the next one can only begin where this one ended
+        start = end - 1
+
+
+def repeat_matches(password):
+    for match in REPEAT_PATTERN.finditer(password):
+        token, base = match.group(0), match.group(1)
+        count = len(token) // len(base)
+        base_guesses = 2 ** estimate_bits(base)[0] if len(base) > 1 else character_pool(base)
+        yield Match("repeat", match.start(), match.end(), token, base_guesses * count)
+
+
+def estimate_bits(password):
+    # cheapest way to cover the password with known patterns, characters outside them are brute forced;
+    # returns (bits, matches along that cover)
+    password = password[:MAX_PASSWORD_LENGTH]
+    if not password:
+        return 0.0, []
+    matches_by_end = {}
+    for finder in (dictionary_matches, keyboard_matches, sequence_matches, repeat_matches):
+        for match in finder(password):
+            matches_by_end.setdefault(match.end, []).append(match)
+
+    brute_force_bits = math.log2(character_pool(password))
+    best = [(0.0, None)] + [(math.inf, None)] * len(password)
+    for end in range(1, len(password) + 1):
+        best[end] = (best[end - 1][0] + brute_force_bits, None)
+        for match in matches_by_end.get(end, ()):
+            bits = best[match.start][0] + math.log2(max(match.guesses, 1))
+            if bits < best[end][0]:
+                best[end] = (bits, match)
+
+    cover, position = [], len(password)
+    while position > 0:
+        match = best[position][1]
+        if match is None:
+            position -= 1
+        else:
+            cover.append(match)
+            position = match.start
+    return best[-1][0], cover[::-1]
+
+
+def strength(bits):
+    for limit, label in STRENGTH_LEVELS:
+        if bits < limit:
+            return label
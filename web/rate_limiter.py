@@ -0,0 +1,164 @@
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from web.jobs import queue
+
+
+SLOT = struct.Struct("=Qdd")  # key hash, tokens left, last update
+SLOTS = 65536
+PROBES = 8
+STATE_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+STATE_FILE = os.environ.get("RATE_LIMIT_STATE", os.path.join(STATE_DIR, "security-project-login-limiter"))
+
+# (burst, tokens refilled per second)
+USERNAME_LIMIT = (int(os.environ.get("LOGIN_USER_BURST", "5")), 1 / float(os.environ.get("LOGIN_USER_REFILL_S", "60")))
+IP_LIMIT = (int(os.environ.get("LOGIN_IP_BURST", "20")), 1 / float(os.environ.get("LOGIN_IP_REFILL_S", "6")))
+FAILED_LOGIN_FLUSH_SECONDS = float(os.environ.get("FAILED_LOGIN_FLUSH_SECONDS", "10"))
+
+
+class SharedTokenBuckets:
+    # token buckets in a memory-mapped file, shared by every worker process on the host;
+    # a fixed-size hash table, so an attempt costs a lock and a few memory reads instead of a database write
+    def __init__(self, path=STATE_FILE, slots=SLOTS):
+        self.slots = slots
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.fd_pid = os.getpid()
+        size = slots * SLOT.size
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        # flock excludes other processes, threads of this process share the descriptor and need their own lock
+        self.lock = threading.Lock()
+
+    def descriptor(self):
+        # flock belongs to the open file description, which forked workers would share with a preloading master
+        if self.fd_pid != os.getpid():
+            self.fd, self.fd_pid = os.open(self.path, os.O_RDWR), os.getpid()
+        return self.fd
+
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            fd = self.descriptor()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def take(self, key, capacity, refill_per_second):
+        key_hash = self._hash(key)
+        now = time.time()
+        with self.locked():
+            offset = self._find(key_hash)
+            stored_hash, tokens, updated = SLOT.unpack_from(self.map, offset)
+            if stored_hash != key_hash:
+                tokens, updated = capacity, now
+            tokens = min(capacity, tokens + max(0.0, now - updated) * refill_per_second)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            SLOT.pack_into(self.map, offset, key_hash, tokens, now)
+            return allowed
+
+    def reset(self, key, capacity):
+        key_hash = self._hash(key)
+        with self.locked():
+            SLOT.pack_into(self.map, self._find(key_hash), key_hash, capacity, time.time())
+
+    def add(self, key, amount):
+        # a plain counter in the same table, its tokens field holds the count
+        key_hash = self._hash(key)
+        with self.locked():
+            offset = self._find(key_hash)
+            stored_hash, count, _ = SLOT.unpack_from(self.map, offset)
+            count = max(0.0, (count if stored_hash == key_hash else 0.0) + amount)
+            SLOT.pack_into(self.map, offset, key_hash, count, time.time())
+            return int(count)
+
+    def _find(self, key_hash):
+        start = key_hash % self.slots
+        oldest_offset, oldest = None, math.inf
+        for probe in range(PROBES):
+            offset = ((start + probe) % self.slots) * SLOT.size
+            stored_hash, _, updated = SLOT.unpack_from(self.map, offset)
+            if stored_hash in (key_hash, 0):
+                return offset
+            if updated < oldest:
+                oldest_offset, oldest = offset, updated
+        # the probe window is full, reuse its least recently touched bucket
+        return oldest_offset
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.blake2b(key.encode("utf8"), digest_size=8).digest(), "little") or 1
+
+
+class LoginRateLimiter:
+    def __init__(self, buckets=None):
+        self._buckets = buckets
+
+    @property
+    def buckets(self):
+        # opened lazily, so every worker maps the file after the fork
+        if self._buckets is None:
+            self._buckets = SharedTokenBuckets()
+        return self._buckets
+
+    def allow(self, username, client_ip):
+        # both buckets are charged, so one attacker cannot spread guesses across usernames either
+        user_allowed = self.buckets.take("user:" + username, *USERNAME_LIMIT)
+        ip_allowed = self.buckets.take("ip:" + str(client_ip), *IP_LIMIT)
+        return user_allowed and ip_allowed
+
+    def succeeded(self, username):
+        self.buckets.reset("user:" + username, USERNAME_LIMIT[0])
+
+
+login_limiter = LoginRateLimiter()
+
+
+class FailedLoginCounts:
+    # failed logins per user in the limiter's shared map: a guess costs no database write, and every worker sees
+    # the count; the users a worker counted failures for are moved into login_monitor by one job per batch
+    def __init__(self, limiter, flush_seconds=FAILED_LOGIN_FLUSH_SECONDS):
+        self.limiter = limiter
+        self.flush_seconds = flush_seconds
+        self.pending = set()
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def add(self, user_id):
+        self.limiter.buckets.add("failed:{}".format(user_id), 1)
+        with self.lock:
+            self.pending.add(user_id)
+            # the first failure of a batch starts its timer, the job reads the counts when it runs
+            if self.timer is None:
+                self.timer = threading.Timer(self.flush_seconds, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            user_ids, self.pending, self.timer = self.pending, set(), None
+        if user_ids:
+            queue.enqueue("flush_failed_logins", user_ids=sorted(user_ids))
+
+    def count(self, user_id):
+        return self.limiter.buckets.add("failed:{}".format(user_id), 0)
+
+    def settle(self, user_id, count):
+        # only what was read is removed, failures counted meanwhile wait for the next flush or login
+        self.limiter.buckets.add("failed:{}".format(user_id), -count)
+
+
+failed_logins = FailedLoginCounts(login_limiter)
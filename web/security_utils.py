@@ -1,4 +1,3 @@
-import math
 import os
 import re
 from collections import Counter
@@ -6,15 +5,28 @@ from datetime import datetime
 from string import ascii_letters, digits
 from flask import flash
 
-import pyscrypt
+import web.dictionary_index as dictionary_index
+import web.kdf as kdf
+from web.metrics import timed
+from web.password_strength import SPECIAL_CHARS, estimate_bits
 
 
 PEPPER = os.environ.get("PEPPER", "VERY_SECRET_AND_COMPLEX_PEPPER")
-SPECIAL_CHARS = "!@#$%^&*()-_+=~`[]{}|:;\"'<>,.?/"
+PASSWORD_DICTIONARY = dictionary_index.load()
 
 
 def hash_password(password, salt):
-    return bytes(pyscrypt.hash(bytes(password + PEPPER, "utf8"), bytes(salt, "utf8"), 2048, 8, 1, 128))
+    with timed("password_hash_duration_seconds", operation="hash"):
+        return kdf.encode(kdf.derive(bytes(password + PEPPER, "utf8"), bytes(salt, "utf8")))
+
+
+def verify_password(password, salt, stored_hash):
+    with timed("password_hash_duration_seconds", operation="verify"):
+        return kdf.verify(bytes(password + PEPPER, "utf8"), bytes(salt, "utf8"), stored_hash)
+
+
+def password_needs_rehash(stored_hash):
+    return kdf.needs_rehash(stored_hash)
 
 
 def validate_username(username):
@@ -117,14 +129,15 @@ def valid_chars(input: str, legal_chars: str) -> bool:
 
 
 def in_dictionary(password):
-    with open("./web/resources/500-worst-passwords.txt", "r") as f:
-        for line in f:
-            if password == line.strip():
-                return True
-    return False
+    return password in PASSWORD_DICTIONARY
 
 
 def entropy(password):
-    total_chars_count = len(ascii_letters + digits + SPECIAL_CHARS)
-    password_length = len(password)
-    return password_length * math.log2(total_chars_count)
+    return password_report(password)[0]
+
+
+def password_report(password):
+    # (bits, matched patterns); leaked passwords are worthless whatever their shape
+    if in_dictionary(password):
+        return 0.0, []
+    return estimate_bits(password)
@@ -0,0 +1,73 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+
+try:
+    import brotli
+except ImportError:  # only the .gz copies are written, nginx serves those to brotli-capable browsers as well
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+BUILD_DIR = "dist"
+MANIFEST_NAME = "manifest.json"
+COMPRESSED_EXTENSIONS = (".css", ".js", ".svg", ".json", ".txt", ".html")
+FINGERPRINT_LENGTH = 12
+
+
+def write_atomically(path, content):
+    # nginx and the workers may read the file while it is written
+    temporary = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary, "wb") as f:
+        f.write(content)
+    os.replace(temporary, path)
+
+
+def build(static_dir=STATIC_DIR):
+    # copies every asset to dist/ under a name carrying its content hash, so it can be cached forever,
+    # with precompressed siblings; files of earlier builds stay for pages that still reference them
+    output = os.path.join(static_dir, BUILD_DIR)
+    manifest = {}
+    for root, dirs, files in os.walk(static_dir):
+        if root == static_dir:
+            dirs[:] = [d for d in dirs if d != BUILD_DIR]
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, static_dir).replace(os.sep, "/")
+            with open(path, "rb") as f:
+                content = f.read()
+            stem, extension = os.path.splitext(relative)
+            fingerprinted = "{}.{}{}".format(stem, hashlib.sha256(content).hexdigest()[:FINGERPRINT_LENGTH], extension)
+            target = os.path.join(output, fingerprinted)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if not os.path.exists(target):
+                write_atomically(target, content)
+                if extension in COMPRESSED_EXTENSIONS:
+                    write_atomically(target + ".gz", gzip.compress(content, 9, mtime=0))
+                    if brotli:
+                        write_atomically(target + ".br", brotli.compress(content, quality=11))
+            manifest[relative] = BUILD_DIR + "/" + fingerprinted
+    os.makedirs(output, exist_ok=True)
+    write_atomically(os.path.join(output, MANIFEST_NAME), json.dumps(manifest, indent=2, sort_keys=True).encode())
+    return manifest
+
+
+def load_manifest(static_dir=STATIC_DIR):
+    try:
+        with open(os.path.join(static_dir, BUILD_DIR, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fingerprint and precompress the static assets")
+    parser.add_argument("--static-dir", default=STATIC_DIR)
+    args = parser.parse_args()
+    manifest = build(args.static_dir)
+    print("Built {} assets{}.".format(len(manifest), "" if brotli else " (brotli is not installed, gzip only)"))
+
+
+if __name__ == "__main__":
+    main()
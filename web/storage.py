@@ -0,0 +1,97 @@
+import os
+import sqlite3
+from functools import wraps
+
+from flask import g, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+REPLICA_BIND = "replica"
+
+SQLITE_PRAGMAS = {
+    # readers no longer block the writer and the writer no longer blocks readers
+    "journal_mode": os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+    "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+    # durable across application crashes; with WAL only a power loss can drop the last transactions
+    "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+}
+
+POOL_OPTIONS = {
+    "pool_size": int(os.environ.get("DB_POOL_SIZE", "10")),
+    "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", "22")),
+    "pool_timeout": int(os.environ.get("DB_POOL_TIMEOUT", "10")),
+}
+
+POSTGRES_POOL_OPTIONS = {
+    **POOL_OPTIONS,
+    "pool_pre_ping": True,
+    "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", "1800")),
+}
+
+
+def normalize_url(url):
+    # the scheme most hosting providers hand out is no longer accepted by SQLAlchemy
+    if url.startswith("postgres://"):
+        return "postgresql://" + url[len("postgres://"):]
+    return url
+
+
+def engine_options(url):
+    if url.startswith("postgresql"):
+        return dict(POSTGRES_POOL_OPTIONS)
+    if url.startswith("sqlite") and url not in ("sqlite://", "sqlite:///:memory:"):
+        return dict(POOL_OPTIONS)
+    return {}
+
+
+def database_config(default_url):
+    url = normalize_url(os.environ.get("DATABASE_URL", default_url))
+    config = {
+        "SQLALCHEMY_DATABASE_URI": url,
+        "SQLALCHEMY_ENGINE_OPTIONS": engine_options(url),
+    }
+    replica_url = os.environ.get("DATABASE_REPLICA_URL")
+    if replica_url:
+        replica_url = normalize_url(replica_url)
+        config["SQLALCHEMY_BINDS"] = {REPLICA_BIND: {"url": replica_url, **engine_options(replica_url)}}
+    return config
+
+
+def set_sqlite_pragmas(dbapi_connection):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute("PRAGMA {} = {}".format(pragma, value))
+    cursor.close()
+
+
+@event.listens_for(Engine, "connect")
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        set_sqlite_pragmas(dbapi_connection)
+
+
+class RoutingSession(Session):
+    # sends reads of views marked with @read_only to the replica, everything else to the primary
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context() and g.get("read_only"):
+            engines = self._db.engines
+            if REPLICA_BIND in engines:
+                return engines[REPLICA_BIND]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def read_only(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_only = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def dispose_engines(app):
+    # pooled connections opened before a fork must not be used by two processes, the worker opens its own lazily
+    with app.app_context():
+        for engine in app.extensions["sqlalchemy"].engines.values():
+            engine.dispose(close=False)
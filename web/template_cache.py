@@ -0,0 +1,60 @@
+import os
+import threading
+
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+
+FRAGMENT_CACHE_SIZE = int(os.environ.get("FRAGMENT_CACHE_SIZE", "4096"))
+
+
+class FragmentCache:
+    # rendered HTML of this worker, one entry per (fragment, scope) holding the ledger generation it was rendered at;
+    # a loan transition bumps the generation, so the entry is re-rendered on the next view and never served stale
+    def __init__(self, size):
+        self.size = size
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_render(self, name, scope, generation, render):
+        key = (name, scope)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[0] == generation:
+                self.entries[key] = entry  # dicts keep insertion order, re-inserting marks it recently used
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        html = Markup(render())
+        with self.lock:
+            # a slower render of an older generation must not replace a newer entry
+            current = self.entries.get(key)
+            if current is None or current[0] <= generation:
+                self.entries.pop(key, None)
+                self.entries[key] = (generation, html)
+            while len(self.entries) > self.size:
+                del self.entries[next(iter(self.entries))]
+        return html
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+fragments = FragmentCache(FRAGMENT_CACHE_SIZE)
+
+
+def init_app(app):
+    # compiled templates are written next to the instance folder and shared by every worker on the host,
+    # a worker only compiles the templates nobody has compiled since they last changed
+    directory = os.environ.get("JINJA_CACHE_DIR") or os.path.join(app.instance_path, "jinja_cache")
+    os.makedirs(directory, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+
+def compile_templates(app):
+    names = app.jinja_env.list_templates(extensions=["html"])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
@@ -0,0 +1,64 @@
+import logging
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import request
+
+from web.metrics import registry
+
+
+logger = logging.getLogger(__name__)
+
+# every POST to these endpoints is answered at the same time after it arrived, whatever the outcome
+RESPONSE_DEADLINES = {
+    "login": float(os.environ.get("LOGIN_RESPONSE_DEADLINE", "1.0")),
+    "recover": float(os.environ.get("RECOVER_RESPONSE_DEADLINE", "1.0")),
+}
+# requests one worker serves for these endpoints at once, each holds a gthread thread until its deadline;
+# the worker's other threads stay free for the rest of the site (under uvicorn the wait holds no thread)
+MAX_WAITING = int(os.environ.get("RESPONSE_DEADLINE_SLOTS", "16"))
+BUSY_RETRY_SECONDS = 1
+waiting_slots = threading.BoundedSemaphore(MAX_WAITING)
+
+
+def remaining_until(deadline, endpoint):
+    remaining = deadline - time.monotonic()
+    if remaining < 0:
+        logger.warning("%s took %.3fs longer than its response deadline", endpoint, -remaining)
+        return 0.0
+    registry.observe("response_deadline_wait_seconds", remaining, endpoint=endpoint)
+    return remaining
+
+
+def wait_until(deadline, endpoint):
+    # with gthread workers this parks a single thread, the worker process keeps serving other requests
+    time.sleep(remaining_until(deadline, endpoint))
+
+
+def busy_response(endpoint):
+    # refused before the view runs, so neither the answer nor its timing depends on the credentials
+    registry.inc("response_deadline_busy_total", endpoint=endpoint)
+    return "Too many requests in progress, please try again.", 503, {"Retry-After": str(BUSY_RETRY_SECONDS)}
+
+
+def equalize_response_time(endpoint):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != "POST":
+                return view(*args, **kwargs)
+            if not waiting_slots.acquire(blocking=False):
+                return busy_response(endpoint)
+            deadline = time.monotonic() + RESPONSE_DEADLINES[endpoint]
+            # errors too, a 400 for a missing form field must not come back sooner than a wrong password
+            try:
+                return view(*args, **kwargs)
+            finally:
+                try:
+                    wait_until(deadline, endpoint)
+                finally:
+                    waiting_slots.release()
+        return wrapper
+    return decorator
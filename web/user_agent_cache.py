@@ -0,0 +1,47 @@
+import os
+from collections import namedtuple
+from functools import lru_cache
+
+from user_agents import parse
+
+UA_CACHE_SIZE = int(os.environ.get("UA_CACHE_SIZE", "1024"))
+
+UserAgentInfo = namedtuple("UserAgentInfo", [
+    "browser_family", "browser_version", "os_family", "os_version",
+    "device_family", "device_brand", "device_model",
+    "is_mobile", "is_tablet", "is_pc", "is_bot",
+])
+
+
+def parse_user_agent(header):
+    # the properties of a parsed UserAgent are evaluated lazily, so everything LoginLog needs is read once here
+    # and kept as an immutable tuple that can be shared between threads
+    user_agent = parse(header or "")
+    return UserAgentInfo(
+        browser_family=user_agent.browser.family,
+        browser_version=user_agent.browser.version_string,
+        os_family=user_agent.os.family,
+        os_version=user_agent.os.version_string,
+        device_family=user_agent.device.family or "N/A",
+        device_brand=user_agent.device.brand or "N/A",
+        device_model=user_agent.device.model or "N/A",
+        is_mobile=user_agent.is_mobile,
+        is_tablet=user_agent.is_tablet,
+        is_pc=user_agent.is_pc,
+        is_bot=user_agent.is_bot,
+    )
+
+
+cached_user_agent = lru_cache(maxsize=UA_CACHE_SIZE)(parse_user_agent)
+
+
+def cache_stats():
+    info = cached_user_agent.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        "hits": info.hits,
+        "misses": info.misses,
+        "size": info.currsize,
+        "max_size": info.maxsize,
+        "hit_rate": info.hits / lookups if lookups else 0.0,
+    }
@@ -0,0 +1,138 @@
+from datetime import timedelta, date
+
+from flask import Blueprint, render_template, request, redirect, flash, url_for, jsonify
+from flask_login import login_user, logout_user, login_required
+
+import web.jobs as jobs
+import web.security_utils as su
+from web.password_strength import strength
+from web.rate_limiter import login_limiter, failed_logins
+from web.timing import equalize_response_time
+from web.user_agent_cache import cached_user_agent
+from web.models.user_models import User, LoginLog, LoginMonitor
+
+bp = Blueprint("auth", __name__)
+
+
+@bp.route("/")
+def hello_world():
+    return render_template("index.html")
+
+
+@bp.route("/login", methods=["GET", "POST"])
+@equalize_response_time("login")
+def login():
+    if request.method == "GET":
+        return render_template("pages/index/login.html")
+    if request.method == "POST":
+        username = request.form["username"]
+        password = request.form["password"]
+        if not su.login_data_is_valid(username, password):
+            return render_template("pages/index/login.html"), 401
+        if not login_limiter.allow(username, request.remote_addr):
+            flash("Too many login attempts. Please try again later.", "danger")
+            return render_template("pages/index/login.html"), 429
+
+        user = User.query.filter_by(username=username).first()
+        if not user:
+            flash("Login unsuccessful. Please check your username and password.", "danger")
+            return render_template("pages/index/login.html"), 401
+        if not user.check_password(password):
+            flash("Login unsuccessful. Please check your username and password.", "danger")
+            failed_logins.add(user.id)
+            return render_template("pages/index/login.html"), 401
+        login_user(user)
+        login_limiter.succeeded(username)
+
+        user_agent = cached_user_agent(request.headers.get('User-Agent'))
+        current_login = LoginLog(user.id, user_agent)
+        current_login.add_to_db()
+        # the new CSRF token is in the login log, the anomaly checks can wait for the job queue
+        jobs.queue.enqueue("login_followup", user_id=user.id, login_log_id=current_login.id)
+
+        return redirect(url_for("ledger.home"))
+
+
+@bp.route("/register", methods=["GET", "POST"])
+def register():
+    if request.method == "GET":
+        return render_template("pages/index/register.html")
+    if request.method == "POST":
+        username = request.form["username"]
+        password = request.form["password"]
+        second_password = request.form["password-repeat"]
+        first_name, last_name = request.form["firstname"], request.form["lastname"]
+
+        if not su.registration_data_is_valid(username, first_name, last_name, password, second_password):
+            return render_template("pages/index/register.html")
+
+        if User.query.filter_by(username=username).first():
+            flash("Username already taken.", "danger")
+            return render_template("pages/index/register.html")
+
+        user = User(username, first_name, last_name, password)
+        user.add_to_db()
+        login_user(user, duration=timedelta(hours=1))
+        login_monitor = LoginMonitor(user.id, date.today(), 0)
+        login_monitor.add_to_db()
+
+        user_agent = cached_user_agent(request.headers.get('User-Agent'))
+        current_login = LoginLog(user.id, user_agent)
+        current_login.add_to_db()
+
+        return render_template("pages/index/recovery_password.html", user=user, new_acount=True), 201
+
+
+@bp.route("/recover", methods=["GET", "POST"])
+@equalize_response_time("recover")
+def recover():
+    if request.method == "GET":
+        return render_template("pages/index/recover_password.html")
+    if request.method == "POST":
+        username = request.form["username"]
+        recovery_password = request.form["recovery-password"]
+        new_password, repeat_new_password = request.form["new-password"], request.form["repeat-new-password"]
+        if su.recovery_data_is_valid(username, recovery_password, new_password, repeat_new_password):
+            flash("Invalid data.", "danger")
+            return render_template("pages/index/recover_password.html"), 400
+
+        user = User.query.filter_by(username=username).first()
+        if not user:
+            flash("No such user.", "danger")
+            return render_template("pages/index/recover_password.html"), 400
+
+        if user.recovery_password != recovery_password:
+            flash("Incorrect recovery password.", "danger")
+            return render_template("pages/index/recover_password.html"), 400
+
+        user.recover(new_password)
+        login_user(user)
+        return render_template("pages/index/recovery_password.html", user=user, new_account=False)
+
+
+@bp.route("/logout")
+@login_required
+def logout():
+    logout_user()
+    return redirect(url_for("auth.hello_world"))
+
+
+@bp.route("/session-expired")
+@login_required
+def session_expired():
+    logout_user()
+    return render_template("pages/index/session_expired.html")
+
+
+@bp.route("/entropy/<what>", methods=["POST"])
+def entropy(what):
+    if what == "register":
+        password = request.form["password"]
+    else:
+        password = request.form["new-password"]
+    bits, matches = su.password_report(password)
+    if request.args.get("format") == "json" or request.accept_mimetypes.best == "application/json":
+        return jsonify(entropy=round(bits, 2), strength=strength(bits),
+                       patterns=[{"pattern": match.pattern, "start": match.start, "end": match.end}
+                                 for match in matches])
+    return render_template("snippets/entropy.html", entropy=bits)
@@ -0,0 +1,320 @@
+import io
+from datetime import datetime
+
+from flask import Blueprint, render_template, request, redirect, flash, url_for, Response, stream_with_context, \
+    jsonify, current_app
+from flask_login import login_required, current_user
+from werkzeug.exceptions import RequestEntityTooLarge
+
+import web.analytics as analytics
+import web.http_cache as http_cache
+import web.inbox as inbox
+import web.ledger_io as ledger_io
+import web.metrics as metrics
+import web.security_utils as su
+import web.template_cache as template_cache
+from web.storage import read_only
+from web.models.balance_models import GLOBAL_GENERATION, ledger_generation
+from web.models.db_init import db
+from web.models.identity_cache import csrf_token, csrf_token_is_valid
+from web.models.loan_models import Loan, LoanMessage
+from web.models.netting import settlement_plan
+from web.models.notification_model import Notification
+from web.models.pagination import Page
+from web.models.search import search_users
+from web.models.model_handler import get_all_loans, get_all_debts, loans_given, loans_taken, get_logs, \
+    get_messages, get_notifications, count_unresolved_messages, get_inbox_rows
+from web.models.user_models import User
+
+bp = Blueprint("ledger", __name__)
+
+
+@bp.route("/home", methods=["GET"])
+@login_required
+@http_cache.conditional(lambda user: user.id)
+def home():
+    balances = template_cache.fragments.get_or_render(
+        "balances", current_user.id, ledger_generation(current_user.id),
+        lambda: render_template("snippets/_balances.html", loans_given=loans_given(current_user),
+                                loans_taken=loans_taken(current_user)))
+    return render_template("pages/home/home.html", user=current_user, balances=balances)
+
+
+@bp.route("/messages")
+@login_required
+def messages():
+    messages = get_messages(current_user)
+    notifications = get_notifications(current_user)
+    return render_template("pages/home/messages.html", messages=messages, notifications=notifications,
+                           unread=count_unresolved_messages(current_user), token=csrf_token(current_user))
+
+
+def inbox_event_ids(events):
+    ids = {"message": [], "notification": []}
+    for _, _, kind, row_id in events:
+        ids[kind].append(row_id)
+    return ids
+
+
+def render_inbox_events(messages, notifications, unread, token):
+    # (event name, data) pairs of the stream, shared with the ASGI variant of the view
+    rendered = []
+    if messages:
+        rendered.append(("message", render_template("snippets/_message_rows.html", page=Page(messages, None),
+                                                     token=token)))
+    if notifications:
+        rendered.append(("notification", render_template("snippets/_notification_rows.html",
+                                                         page=Page(notifications, None))))
+    rendered.append(("unread", str(unread)))
+    return rendered
+
+
+@bp.route("/messages/stream")
+@login_required
+def messages_stream():
+    user = current_user._get_current_object()
+    db.session.remove()  # the stream is long-lived, connections are only taken while rendering
+
+    def render(events):
+        ids = inbox_event_ids(events)
+        messages = get_inbox_rows(user, LoanMessage, ids["message"]) if ids["message"] else []
+        notifications = get_inbox_rows(user, Notification, ids["notification"]) if ids["notification"] else []
+        rendered = render_inbox_events(messages, notifications, count_unresolved_messages(user), csrf_token(user))
+        db.session.remove()
+        return rendered
+
+    last_event_id = request.headers.get("Last-Event-ID", type=int)
+    return Response(stream_with_context(inbox.stream(user.id, last_event_id, render)), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@bp.route("/new-loan", methods=["GET", "POST"])
+@login_required
+def new_loan():
+    if request.method == "GET":
+        return render_template("pages/home/new_loan.html", token=csrf_token(current_user))
+    if request.method == "POST":
+        if not csrf_token_is_valid(current_user, request.form["CSRFToken"]):
+            return redirect(url_for("auth.session_expired"))
+
+        lender = User.query.filter_by(username=request.form["lender"]).first()
+        if not lender:
+            flash("No such user.", "danger")
+            return render_template("pages/home/new_loan.html", token=csrf_token(current_user))
+        if not su.validate_new_loan(request.form["deadline"], request.form["amount"]):
+            flash("Invalid loan data.", "danger")
+            return render_template("pages/home/new_loan.html", token=csrf_token(current_user))
+
+        deadline = datetime.strptime(request.form["deadline"], "%Y-%m-%d")
+        loan = Loan(lender, current_user._get_current_object(), request.form["amount"], deadline)
+        loan.add_to_db()
+
+        return redirect(url_for("ledger.home"))
+    return redirect(url_for("ledger.home"))
+
+
+@bp.route("/new-loan/<int:id>", methods=["POST"])
+@login_required
+def accept_loan(id):
+    if not csrf_token_is_valid(current_user, request.form["CSRFToken"]):
+        return redirect(url_for("auth.session_expired"))
+
+    message = LoanMessage.query.filter_by(id=id).first()
+    if not message:
+        flash("No such message.", "danger")
+        return redirect(url_for("ledger.home"))
+    loan = message.loan
+    if not loan:
+        flash("No such loan.", "danger")
+        return redirect(url_for("ledger.home"))
+
+    if request.form["accept"] == "true":
+        loan.accept_request(answered=message)
+    else:
+        loan.reject_request(answered=message)
+    return redirect(url_for("ledger.messages"))
+
+
+@bp.route("/loans")
+@login_required
+@http_cache.conditional(lambda user: user.id, with_token=True)
+def loans():
+    loans = get_all_loans(current_user)
+    debts = get_all_debts(current_user)
+    return render_template("pages/home/your_loans.html", loans=loans, debts=debts,
+                           token=csrf_token(current_user))
+
+
+@bp.route("/repay/req/<int:id>/", methods=["POST"])
+@login_required
+def repay_loan_req(id):
+    if not csrf_token_is_valid(current_user, request.form["CSRFToken"]):
+        return redirect(url_for("auth.session_expired"))
+
+    loan = Loan.query.filter_by(id=id).first()
+    if not loan:
+        flash("No such loan.", "danger")
+        return redirect(url_for("ledger.loans"))
+
+    loan.pay_back()
+    return redirect(url_for("ledger.home"))
+
+
+@bp.route("/repay/<int:id>/", methods=["POST"])
+@login_required
+def repay_loan(id):
+    if not csrf_token_is_valid(current_user, request.form["CSRFToken"]):
+        return redirect(url_for("auth.session_expired"))
+
+    message = LoanMessage.query.filter_by(id=id).first()
+    if not message:
+        flash("No such message.", "danger")
+        return redirect(url_for("ledger.messages"))
+    loan = message.loan
+    if not loan:
+        flash("No such loan.", "danger")
+        return redirect(url_for("ledger.messages"))
+
+    if request.form["accept"] == "true":
+        loan.confirm_repayment(answered=message)
+    else:
+        loan.reject_repayment(answered=message)
+    return redirect(url_for("ledger.messages"))
+
+
+@bp.route("/other-loans", methods=["GET"])
+@read_only
+@login_required
+@http_cache.conditional(lambda user: GLOBAL_GENERATION)
+def other_loans():
+    # one page of the users in debt, the search box narrows it down instead of listing everyone
+    q = request.args.get("q", "")
+    page = search_users(q, request.args.get("cursor"), debtors=True)
+    return render_template("pages/home/other_loans.html", page=page, q=q)
+
+
+@bp.route("/other-loans/rows")
+@read_only
+@login_required
+@http_cache.conditional(lambda user: GLOBAL_GENERATION)
+def other_loans_rows():
+    q = request.args.get("q", "")
+    page = search_users(q, request.args.get("cursor"), debtors=True)
+    return render_template("snippets/_debtor_rows.html", page=page, q=q)
+
+
+@bp.route("/users/search")
+@read_only
+@login_required
+def search_users_view():
+    page = search_users(request.args.get("q", ""), request.args.get("cursor"))
+    if request.args.get("format") == "json" or request.accept_mimetypes.best == "application/json":
+        return jsonify(users=[{"username": row.username, "name": row.first_name + " " + row.last_name}
+                              for row in page.items], next_cursor=page.next_cursor)
+    return render_template("snippets/_user_options.html", page=page)
+
+
+@bp.route("/settlements")
+@read_only
+@login_required
+@http_cache.conditional(lambda user: GLOBAL_GENERATION)
+def settlements():
+    plan = settlement_plan()
+    position = next((position for position in plan.positions if position.user_id == current_user.id), None)
+    return render_template("pages/home/settlements.html", plan=plan, position=position, user=current_user)
+
+
+@bp.route("/settlements.json")
+@read_only
+@login_required
+@http_cache.conditional(lambda user: GLOBAL_GENERATION)
+def settlements_json():
+    plan = settlement_plan()
+    return jsonify(generation=plan.generation, pairwise_debts=plan.pairs,
+                   positions=[{"username": position.username, "net": round(position.net, 2)}
+                              for position in plan.positions],
+                   settlements=[{"from": transfer.payer.username, "to": transfer.payee.username,
+                                 "amount": round(transfer.amount, 2)} for transfer in plan.transfers])
+
+
+@bp.route("/admin/analytics")
+@read_only
+@login_required
+def analytics_report():
+    if current_user.username not in metrics.ADMIN_USERS:
+        return "", 404
+    user = None
+    username = request.args.get("user", "").strip()
+    if username:
+        user = db.session.query(User).filter_by(username=username).first()
+        if user is None:
+            return "", 404
+    report = analytics.report(analytics.load_snapshot(), user=user)
+    if request.args.get("format") == "json" or request.accept_mimetypes.best == "application/json":
+        return jsonify(report)
+    return render_template("pages/home/analytics.html", report=report, username=username)
+
+
+@bp.route("/logs")
+@read_only
+@login_required
+@http_cache.conditional(lambda user: user.id)
+def logs():
+    logs = get_logs(current_user)
+    return render_template("pages/home/logs.html", logs=logs)
+
+
+@bp.route("/export/<any(loans, logs):what>.<any(csv, ndjson):fmt>")
+@login_required
+def export_ledger(what, fmt):
+    export = ledger_io.export_loans if what == "loans" else ledger_io.export_loan_logs
+    return Response(stream_with_context(export(fmt, current_user)), mimetype=ledger_io.FORMATS[fmt],
+                    headers={"Content-Disposition": "attachment; filename={}.{}".format(what, fmt)})
+
+
+@bp.route("/import/loans", methods=["POST"])
+@login_required
+def import_loans():
+    if not csrf_token_is_valid(current_user, request.form["CSRFToken"]):
+        return redirect(url_for("auth.session_expired"))
+
+    file = request.files.get("file")
+    fmt = request.form.get("format")
+    if not file or fmt not in ledger_io.FORMATS:
+        flash("Choose a CSV or NDJSON file.", "danger")
+        return redirect(url_for("ledger.new_loan"))
+
+    lines = io.TextIOWrapper(file.stream, encoding="utf8", newline="")
+    result = ledger_io.import_loans(lines, fmt, borrower=current_user._get_current_object())
+    flash("Imported {} loan requests, rejected {} rows.".format(result.imported, result.rejected),
+          "success" if not result.rejected else "danger")
+    for error in result.errors[:10]:
+        flash(error, "danger")
+    return redirect(url_for("ledger.new_loan"))
+
+
+@bp.errorhandler(RequestEntityTooLarge)
+def upload_too_large(error):
+    flash("The file is too large, split it into files of at most {:g} MB.".format(
+        round(current_app.config["MAX_CONTENT_LENGTH"] / (1024 * 1024), 1)), "danger")
+    return redirect(url_for("ledger.new_loan"))
+
+
+# list name -> (page query, rows template)
+PAGINATED_LISTS = {
+    "loans": (get_all_loans, "snippets/_loan_rows.html"),
+    "debts": (get_all_debts, "snippets/_debt_rows.html"),
+    "logs": (get_logs, "snippets/_log_rows.html"),
+    "messages": (get_messages, "snippets/_message_rows.html"),
+    "notifications": (get_notifications, "snippets/_notification_rows.html"),
+}
+
+
+@bp.route("/more/<list_name>")
+@login_required
+def load_more(list_name):
+    if list_name not in PAGINATED_LISTS:
+        return "", 404
+    get_page, template = PAGINATED_LISTS[list_name]
+    page = get_page(current_user, request.args.get("cursor"))
+    return render_template(template, page=page, token=csrf_token(current_user))
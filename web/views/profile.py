@@ -0,0 +1,33 @@
+from flask import Blueprint, render_template, request, redirect, flash, url_for
+from flask_login import login_required, current_user
+
+import web.security_utils as su
+from web.models.identity_cache import csrf_token, csrf_token_is_valid
+
+bp = Blueprint("profile", __name__)
+
+
+@bp.route("/profile", methods=["GET", "POST"])
+@login_required
+def profile():
+    if request.method == "GET":
+        return render_template("pages/home/profile.html", user=current_user, token=csrf_token(current_user))
+    if request.method == "POST":  # change password
+        if not csrf_token_is_valid(current_user, request.form["CSRFToken"]):
+            return redirect(url_for("auth.session_expired"))
+
+        old_password = request.form["old-password"]
+        new_password = request.form["new-password"]
+        second_new_password = request.form["new-password-repeat"]
+        token = csrf_token(current_user)
+
+        if not su.verify_password(old_password, current_user.salt, current_user.password):
+            flash("Wrong password", "error")
+            return render_template("pages/home/profile.html", user=current_user, token=token)
+        if not su.validate_password_change(new_password, second_new_password):
+            return render_template("pages/home/profile.html", user=current_user, token=token)
+
+        current_user.change_password(new_password)
+        flash("Password changed successfully.", "success")
+        return render_template("pages/home/profile.html", user=current_user, token=token)
+    return redirect(url_for("ledger.home"))